@@ -20,6 +20,7 @@ def create_agent(task, prompt, model):
     agent_reply = create_chat_completion(
         model=model,
         messages=messages,
+        call_site="sub_agent",
     )
 
     # Update full message history
@@ -46,10 +47,12 @@ def message_agent(key, message):
     # Add user message to message history before sending to agent
     messages.append({"role": "user", "content": message})
 
-    # Start GPT instance
+    # Start GPT instance, reusing the agent's cached history prefix on the server
     agent_reply = create_chat_completion(
         model=model,
         messages=messages,
+        slot_key=f"sub_agent-{key}",
+        call_site="sub_agent",
     )
 
     # Update full message history
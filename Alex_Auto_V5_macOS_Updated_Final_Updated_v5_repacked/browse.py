@@ -1,7 +1,8 @@
+import asyncio
 import requests
 from bs4 import BeautifulSoup
 from config import Config
-from llm_utils import create_chat_completion
+from llm_utils import acreate_chat_completion, create_chat_completion, route_model, stream_chat_completion
 from urllib.parse import urlparse, urljoin
 
 cfg = Config()
@@ -133,6 +134,43 @@ def create_message(chunk, question):
     }
 
 
+def summarize_chunk(messages):
+    """Summarize one chunk, printing the summary as it streams in when cfg.llm_stream is enabled"""
+    if not cfg.llm_stream:
+        return create_chat_completion(
+            model=route_model("summarize", cfg.fast_llm_model),
+            messages=messages,
+            cache=True,
+            call_site="summarize",
+        )
+
+    stream = stream_chat_completion(
+        model=route_model("summarize", cfg.fast_llm_model),
+        messages=messages,
+        call_site="summarize",
+    )
+    summary = stream.consume(lambda delta: print(delta, end="", flush=True))
+    print()
+    if stream.time_to_first_token is not None:
+        print(f"Time to first token: {stream.time_to_first_token:.2f}s")
+    return summary
+
+
+async def summarize_chunks(chunks, question):
+    """Summarize all chunks concurrently, bounded by the async client's limits"""
+    async def summarize(i, chunk):
+        summary = await acreate_chat_completion(
+            model=route_model("summarize", cfg.fast_llm_model),
+            messages=[create_message(chunk, question)],
+            cache=True,
+            call_site="summarize",
+        )
+        print(f"Summarized chunk {i + 1} / {len(chunks)}")
+        return summary
+
+    return await asyncio.gather(*(summarize(i, chunk) for i, chunk in enumerate(chunks)))
+
+
 def summarize_text(text, question):
     """Summarize text using the LLM model"""
     if not text:
@@ -144,27 +182,23 @@ def summarize_text(text, question):
     summaries = []
     chunks = list(split_text(text))
 
-    for i, chunk in enumerate(chunks):
-        print(f"Summarizing chunk {i + 1} / {len(chunks)}")
-        messages = [create_message(chunk, question)]
+    if cfg.llm_stream:
+        # Streamed summaries are printed as they arrive, so keep them in order
+        for i, chunk in enumerate(chunks):
+            print(f"Summarizing chunk {i + 1} / {len(chunks)}")
+            messages = [create_message(chunk, question)]
 
-        summary = create_chat_completion(
-            model=cfg.fast_llm_model,
-            messages=messages,
-            max_tokens=300,
-        )
-        summaries.append(summary)
+            summary = summarize_chunk(messages)
+            summaries.append(summary)
+    else:
+        summaries = asyncio.run(summarize_chunks(chunks, question))
 
     print(f"Summarized {len(chunks)} chunks.")
 
     combined_summary = "\n".join(summaries)
     messages = [create_message(combined_summary, question)]
 
-    final_summary = create_chat_completion(
-        model=cfg.fast_llm_model,
-        messages=messages,
-        max_tokens=300,
-    )
+    final_summary = summarize_chunk(messages)
 
     return final_summary
 
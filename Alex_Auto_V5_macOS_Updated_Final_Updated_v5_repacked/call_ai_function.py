@@ -2,15 +2,15 @@ from config import Config
 
 cfg = Config()
 
-from llm_utils import create_chat_completion
+from llm_utils import create_chat_completion, route_model
 
 
 # This is a magic function that can do anything with no-code. See
 # https://github.com/Torantulino/AI-Functions for more info.
-def call_ai_function(function, args, description, model=None):
+def call_ai_function(function, args, description, model=None, call_site="ai_function"):
     """Call an AI function"""
     if model is None:
-        model = cfg.smart_llm_model
+        model = route_model(call_site, cfg.smart_llm_model)
     # For each arg, if any are None, convert to "None":
     args = [str(arg) if arg is not None else "None" for arg in args]
     # parse args to comma seperated string
@@ -24,7 +24,7 @@ def call_ai_function(function, args, description, model=None):
     ]
 
     response = create_chat_completion(
-        model=model, messages=messages, temperature=0
+        model=model, messages=messages, temperature=0, call_site=call_site
     )
 
     return response
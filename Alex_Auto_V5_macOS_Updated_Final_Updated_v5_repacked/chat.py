@@ -1,14 +1,232 @@
+import functools
+import json
+import os
+import queue
+import threading
 import time
 import openai
 from dotenv import load_dotenv
 from config import Config
 import token_counter
-from llm_utils import create_chat_completion
+from json_utils import JsonObjectTracker
+from llm_utils import create_chat_completion, get_last_completion_info, route_model, stream_chat_completion
+from llm_metrics import metrics
+from llm_profiles import get_profile
+from history_summary import RollingSummary
 from logger import logger
+from message_history import MessageHistory
+from prompt import get_prompt_generator
 import logging
 
 cfg = Config()
 
+# The reply is a single JSON object, so a closing code fence or the start of a
+# new instruction means the model has moved on to something else
+AGENT_STOP_SEQUENCES = ["\n```\n", "[INST]"]
+
+
+_response_schema = None
+
+
+def get_response_schema():
+    """Return the JSON schema of agent replies, built once from the prompt's response format and commands"""
+    global _response_schema
+    if _response_schema is None:
+        _response_schema = get_prompt_generator().generate_response_schema()
+    return _response_schema
+
+
+_command_args = None
+
+
+def get_command_args():
+    """Return the argument names of each command listed in the prompt"""
+    global _command_args
+    if _command_args is None:
+        _command_args = {command["name"]: set(command["args"]) for command in get_prompt_generator().commands}
+    return _command_args
+
+
+def get_command_names():
+    """Return the names of the commands listed in the prompt"""
+    return set(get_command_args())
+
+
+def validate_reply(reply):
+    """
+    Check an agent reply against the command table of the prompt.
+
+    Args:
+    reply (str): The assistant reply.
+
+    Returns:
+    tuple: The command name as sent (None if there is none) and the problem found:
+        "unparsable", "unknown_command", "missing_args" or None if the reply is valid.
+    """
+    # Only plain JSON counts: the reply is the text between its outermost braces, with no repairs
+    start = reply.find("{")
+    end = reply.rfind("}")
+    if start < 0 or end < start:
+        return None, "unparsable"
+    try:
+        reply_json = json.loads(reply[start:end + 1])
+    except ValueError:
+        return None, "unparsable"
+    command = reply_json.get("command") if isinstance(reply_json, dict) else None
+    if not isinstance(command, dict):
+        return None, "unparsable"
+    name = command.get("name")
+    if not isinstance(name, str):
+        return None, "unknown_command"
+    if name not in get_command_args():
+        # Keep the name the model sent for the logs
+        return name, "unknown_command"
+    args = command.get("args")
+    if not isinstance(args, dict) or not get_command_args()[name] <= set(args):
+        return name, "missing_args"
+    return name, None
+
+
+def is_valid_reply(reply):
+    """Return True if reply parses and names a known command with all its arguments"""
+    return validate_reply(reply)[1] is None
+
+
+def sample_best_reply(n, on_token=None, **kwargs):
+    """
+    Stream n candidate replies concurrently and return the first valid one.
+
+    Each candidate is cut once its JSON object is complete and checked with
+    is_valid_reply; the first valid candidate wins and the others are
+    cancelled. Candidate i is pinned to its own server slot ("agent",
+    "agent-1", ...), so set LLM_SERVER_SLOTS to at least n.
+
+    Args:
+    n (int): The number of candidates.
+    on_token (callable, optional): Called with every delta of every candidate.
+    **kwargs: Passed to stream_chat_completion.
+
+    Returns:
+    tuple: The chosen reply (the first finished one if none is valid) and its
+        get_last_completion_info().
+    """
+    results = queue.Queue()
+    lock = threading.Lock()
+    streams = []
+    chosen = []
+
+    def sample(index):
+        try:
+            stream = stream_chat_completion(slot_key="agent" if index == 0 else f"agent-{index}", **kwargs)
+        except Exception as e:
+            results.put((index, None, None, None, e))
+            return
+        with lock:
+            streams.append(stream)
+            lost = bool(chosen)
+        if lost:
+            stream.cancel()
+            return
+        try:
+            reply = stream.consume(on_token, until=JsonObjectTracker().feed)
+        except Exception as e:
+            results.put((index, None, None, None, e))
+            return
+        results.put((index, stream, reply, get_last_completion_info(), None))
+
+    for index in range(n):
+        threading.Thread(target=sample, args=(index,), name="agent-sample", daemon=True).start()
+
+    fallback = None
+    first_error = None
+    for _ in range(n):
+        index, stream, reply, info, error = results.get()
+        if error is not None:
+            first_error = first_error or error
+            continue
+        if is_valid_reply(reply):
+            with lock:
+                chosen.append(stream)
+                losers = [other for other in streams if other is not stream]
+            for loser in losers:
+                loser.cancel()
+            metrics.incr(f"llm_n_best_wins[candidate={index}]")
+            return reply, info
+        metrics.incr("llm_n_best_invalid")
+        if fallback is None:
+            fallback = (reply, info)
+    if fallback is None:
+        raise first_error
+    return fallback
+
+
+_n_best_capped = False
+
+
+def n_best_candidates():
+    """Return how many agent replies to sample: LLM_N_BEST, capped at the server's LLM_SERVER_SLOTS"""
+    global _n_best_capped
+    slots = max(cfg.llm_server_slots, 1)
+    if cfg.llm_n_best <= slots:
+        return cfg.llm_n_best
+    if not _n_best_capped:
+        _n_best_capped = True
+        logger.warn(f"LLM_N_BEST={cfg.llm_n_best} exceeds LLM_SERVER_SLOTS={slots}; "
+                    f"sampling {slots} candidates, as the server would run the rest one after another")
+    return slots
+
+
+def request_reply(model, messages, max_tokens, on_token=None):
+    """
+    Request an agent reply the way the LLM_N_BEST, LLM_STREAM and LLM_STOP_AT_JSON_END settings ask for.
+
+    Args:
+    model (str): The model to ask.
+    messages (list): The context to send.
+    max_tokens (int): The maximum number of tokens of the reply.
+    on_token (callable, optional): Called with each reply delta when streaming.
+
+    Returns:
+    tuple: The reply and its get_last_completion_info().
+    """
+    if n_best_candidates() > 1:
+        return sample_best_reply(
+            n_best_candidates(),
+            on_token,
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens,
+            stop=AGENT_STOP_SEQUENCES,
+            response_schema=get_response_schema(),
+            call_site="agent_turn",
+        )
+    if cfg.llm_stream or cfg.llm_stop_at_json_end:
+        stream = stream_chat_completion(
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens,
+            slot_key="agent",
+            stop=AGENT_STOP_SEQUENCES,
+            response_schema=get_response_schema(),
+            call_site="agent_turn",
+        )
+        # Cancel generation as soon as the command JSON is complete
+        until = JsonObjectTracker().feed if cfg.llm_stop_at_json_end else None
+        reply = stream.consume(on_token, until=until)
+        if stream.time_to_first_token is not None:
+            logger.debug(f"Time to first token: {stream.time_to_first_token:.2f}s")
+        return reply, get_last_completion_info()
+    reply = create_chat_completion(
+        model=model,
+        messages=messages,
+        max_tokens=max_tokens,
+        slot_key="agent",
+        stop=AGENT_STOP_SEQUENCES,
+        response_schema=get_response_schema(),
+        call_site="agent_turn",
+    )
+    return reply, get_last_completion_info()
+
 
 def create_chat_message(role, content):
     """
@@ -24,6 +242,73 @@ def create_chat_message(role, content):
     return {"role": role, "content": content}
 
 
+# The plain list last passed to chat_with_ai and the MessageHistory that mirrors it
+_list_history = (None, None)
+
+
+def as_message_history(messages):
+    """
+    Return messages as a MessageHistory.
+
+    A plain list is mirrored by a MessageHistory that is kept across turns:
+    messages appended since the last call are counted, so neither the token
+    counts nor the history's running summary are rebuilt every turn. If the
+    list was changed other than by appending, the mirror is rebuilt.
+    """
+    global _list_history
+    if isinstance(messages, MessageHistory):
+        return messages
+    mirrored, history = _list_history
+    if (mirrored is not messages or len(history) > len(messages)
+            or (history and history[-1] is not messages[len(history) - 1])):
+        history = MessageHistory(messages)
+        _list_history = (messages, history)
+    else:
+        history.extend(messages[len(history):])
+    return history
+
+
+# Limit of the system prompts and memories of the context, if LLM_MEMORY_BUDGET is not set
+CONTEXT_PROMPT_TOKENS = 2500
+
+
+@functools.lru_cache(maxsize=8)
+def count_prompt_tokens(prompt, model):
+    """Return the token count of the system prompt message; it only changes between sessions"""
+    return token_counter.count_message_tokens([create_chat_message("system", prompt)], model)
+
+
+def pack_memories(memories, budget, model):
+    """
+    Choose the retrieved memories that go into the context.
+
+    Every memory is tokenized once. Relevance is taken from the rank
+    get_relevant returns the memory at (the memory ranked r is worth
+    1 / (r + 1)), and memories are taken greedily by relevance per token
+    while they fit the budget.
+
+    Args:
+    memories (list): The memories, most relevant first.
+    budget (int): The number of tokens the memories may use.
+    model (str): The model the memories are counted for.
+
+    Returns:
+    list: The chosen memories, in their original order.
+    """
+    if not memories:
+        return memories
+    # Memories are rendered as a list, so count each with its quotes and separator
+    costs = [token_counter.count_string_tokens(repr(memory), model) + 1 for memory in memories]
+    order = sorted(range(len(memories)), key=lambda rank: 1 / (rank + 1) / max(costs[rank], 1), reverse=True)
+    chosen = set()
+    used = 0
+    for rank in order:
+        if used + costs[rank] <= budget:
+            chosen.add(rank)
+            used += costs[rank]
+    return [memories[rank] for rank in sorted(chosen)]
+
+
 def generate_context(prompt, relevant_memory, full_message_history, model):
     current_context = [
         create_chat_message(
@@ -35,19 +320,64 @@ def generate_context(prompt, relevant_memory, full_message_history, model):
 
     # Add messages from the full message history until we reach the token limit
     next_message_to_add_index = len(full_message_history) - 1
-    insertion_index = len(current_context)
-    # Count the currently used tokens
-    current_tokens_used = token_counter.count_message_tokens(current_context, model)
+    # The time and memories change every turn; in the stable layout they go after the history,
+    # so only the end of the context differs from the previous turn's
+    insertion_index = 1 if cfg.llm_stable_context else len(current_context)
+    # Count the currently used tokens. The system prompt is counted once per session; both
+    # counts include the 3 tokens priming the reply, so subtract them once.
+    current_tokens_used = count_prompt_tokens(prompt, model) + token_counter.count_message_tokens(current_context[1:], model) - 3
     return next_message_to_add_index, current_tokens_used, insertion_index, current_context
 
 
+def shared_prefix_length(previous, current):
+    """
+    Measure how much of a context repeats the start of the previous one.
+
+    Args:
+    previous (list): The messages sent the turn before.
+    current (list): The messages sent this turn.
+
+    Returns:
+    tuple: The number of leading messages that are identical, and the number
+        of leading characters of the rendered contexts that are identical.
+    """
+    messages = 0
+    chars = 0
+    for before, now in zip(previous, current):
+        if before == now:
+            messages += 1
+            chars += len(now["role"]) + len(now["content"])
+            continue
+        if before["role"] == now["role"]:
+            chars += len(now["role"]) + len(os.path.commonprefix([before["content"], now["content"]]))
+        break
+    return messages, chars
+
+
+_previous_context = []
+
+
+def report_shared_prefix(current_context):
+    """Log and publish how much of this turn's context the server's prefix cache can reuse from the last turn"""
+    global _previous_context
+    messages, chars = shared_prefix_length(_previous_context, current_context)
+    total = sum(len(message["role"]) + len(message["content"]) for message in current_context)
+    _previous_context = list(current_context)
+    ratio = chars / total if total else 0.0
+    metrics.set_gauge("llm_context_shared_prefix_messages", messages)
+    metrics.set_gauge("llm_context_shared_prefix_chars", chars)
+    metrics.set_gauge("llm_context_shared_prefix_ratio", ratio)
+    logger.debug(f"Shared prefix with the previous turn: {messages} messages, {chars}/{total} characters ({ratio:.0%})")
+
+
 # TODO: Change debug from hardcode to argument
 def chat_with_ai(
         prompt,
         user_input,
         full_message_history,
         permanent_memory,
-        token_limit):
+        token_limit,
+        on_token=None):
     """Interact with the OpenAI API, sending the prompt, user input, message history, and permanent memory."""
     while True:
         try:
@@ -60,53 +390,59 @@ def chat_with_ai(
             full_message_history (list): The list of all messages sent between the user and the AI.
             permanent_memory (Obj): The memory object containing the permanent memory.
             token_limit (int): The maximum number of tokens allowed in the API call.
+            on_token (callable, optional): Called with each reply delta when cfg.llm_stream is enabled.
 
             Returns:
             str: The AI's response.
             """
-            model = cfg.fast_llm_model # TODO: Change model from hardcode to argument
+            model = route_model("agent_turn", cfg.fast_llm_model)
             # Reserve 1000 tokens for the response
 
+            # The agent turn's performance profile may give it a different context size
+            token_limit = get_profile("agent_turn").get("n_ctx", token_limit)
             logger.debug(f"Token limit: {token_limit}")
-            send_token_limit = token_limit - 1000
+            # Budget in tiktoken estimates, calibrated against the server's own prompt token counts
+            send_token_limit = token_counter.calibration.budget(model, token_limit - 1000)
 
             relevant_memory = '' if len(full_message_history) ==0 else  permanent_memory.get_relevant(str(full_message_history[-9:]), 10)
 
             logger.debug(f'Memory Stats: {permanent_memory.get_stats()}')
 
+            # Pack memories into their budget in one pass instead of dropping them one at a time
+            memory_budget = cfg.llm_memory_budget
+            if not memory_budget:
+                memory_budget = CONTEXT_PROMPT_TOKENS - generate_context(prompt, [], full_message_history, model)[1]
+            relevant_memory = pack_memories(relevant_memory, memory_budget, model)
+
             next_message_to_add_index, current_tokens_used, insertion_index, current_context = generate_context(
                 prompt, relevant_memory, full_message_history, model)
 
-            while current_tokens_used > 2500:
-                # remove memories until we are under 2500 tokens
-                relevant_memory = relevant_memory[1:]
-                next_message_to_add_index, current_tokens_used, insertion_index, current_context = generate_context(
-                    prompt, relevant_memory, full_message_history, model)
-
             current_tokens_used += token_counter.count_message_tokens([create_chat_message("user", user_input)], model) # Account for user input (appended later)
 
-            while next_message_to_add_index >= 0:
-                # print (f"CURRENT TOKENS USED: {current_tokens_used}")
-                message_to_add = full_message_history[next_message_to_add_index]
-
-                tokens_to_add = token_counter.count_message_tokens([message_to_add], model)
-                if current_tokens_used + tokens_to_add > send_token_limit:
-                    break
-
-                # Add the most recent message to the start of the current context, after the two system prompts.
-                current_context.insert(insertion_index, full_message_history[next_message_to_add_index])
-
-                # Count the currently used tokens
-                current_tokens_used += tokens_to_add
-
-                # Move to the next most recent message in the full message history
-                next_message_to_add_index -= 1
+            # Add the most recent messages that fit, after the system prompts. Their token counts are
+            # kept by MessageHistory, so old messages are not re-tokenized every turn.
+            history = as_message_history(full_message_history)
+            if cfg.llm_history_summary and history.summary is None:
+                history.summary = RollingSummary(cfg.llm_history_summary_every, cfg.llm_history_summary_tokens)
+            summary_message, summarized_until = history.summary.message() if history.summary else (None, 0)
+            if summary_message:
+                # Older work, folded into a summary in the background, goes before the history window
+                current_context.insert(insertion_index, summary_message)
+                insertion_index += 1
+                current_tokens_used += token_counter.count_message_tokens([summary_message], model) - 3
+            # Messages already in the summary are not sent again, even when the window grows back over them
+            window_start = max(history.window_start(send_token_limit - current_tokens_used, model), summarized_until)
+            current_context[insertion_index:insertion_index] = history[window_start:]
+            current_tokens_used += history.tokens_since(window_start, model)
+            if history.summary:
+                history.summary.update(history, window_start)
 
             # Append user input, the length of this is accounted for above
             current_context.extend([create_chat_message("user", user_input)])
+            report_shared_prefix(current_context)
 
             # Calculate remaining tokens
-            tokens_remaining = token_limit - current_tokens_used
+            tokens_remaining = token_limit - token_counter.calibration.correct(model, current_tokens_used)
             # assert tokens_remaining >= 0, "Tokens remaining is negative. This should never happen, please submit a bug report at https://www.github.com/Torantulino/Auto-GPT"
 
             # Debug print the current context
@@ -123,11 +459,28 @@ def chat_with_ai(
             logger.debug("----------- END OF CONTEXT ----------------")
 
             # TODO: use a model defined elsewhere, so that model can contain temperature and other settings we care about
-            assistant_reply = create_chat_completion(
-                model=model,
-                messages=current_context,
-                max_tokens=tokens_remaining,
-            )
+            assistant_reply, prefix_cache = request_reply(model, current_context, tokens_remaining, on_token)
+
+            if cfg.llm_cascade:
+                command_name, problem = validate_reply(assistant_reply)
+                # Label only registered commands; anything the model made up shares one series
+                command_label = command_name if command_name in get_command_args() else "unknown"
+                metrics.incr(f"llm_cascade_turns[command={command_label}]")
+                if problem is not None and model != cfg.smart_llm_model:
+                    # The fast model's reply is unusable: re-ask the smart model instead of fixing it up
+                    logger.debug(
+                        f"Escalating agent turn from {model} to {cfg.smart_llm_model}: {problem} (command {command_name!r})")
+                    metrics.incr(f"llm_cascade_escalations[command={command_label},reason={problem}]")
+                    model = cfg.smart_llm_model
+                    assistant_reply, prefix_cache = request_reply(model, current_context, tokens_remaining, on_token)
+
+            if prefix_cache.get("prompt_tokens_evaluated") is not None:
+                logger.debug(
+                    f"Prompt tokens evaluated: {prefix_cache['prompt_tokens_evaluated']}, "
+                    f"reused from cache: {prefix_cache['prompt_tokens_reused']}")
+            if prefix_cache.get("prompt_tokens"):
+                token_counter.calibration.observe(model, current_tokens_used, prefix_cache["prompt_tokens"])
+                logger.debug(f"Estimated prompt tokens: {current_tokens_used}, actual: {prefix_cache['prompt_tokens']}")
 
             # Update full message history
             full_message_history.append(
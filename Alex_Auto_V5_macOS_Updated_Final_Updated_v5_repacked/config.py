@@ -46,6 +46,116 @@ class Config(metaclass=Singleton):
 
         self.openai_api_key = os.getenv("OPENAI_API_KEY")
         self.temperature = float(os.getenv("TEMPERATURE", "1"))
+
+        # "http" to use an OpenAI-compatible server, or "local" to run a GGUF model in-process
+        # with llama-cpp-python, loaded with model_config's load_params and inference_params
+        self.llm_backend = os.getenv("LLM_BACKEND", "http")
+        self.llm_model_path = os.getenv("LLM_MODEL_PATH", "")
+        self.llm_local_gpu_layers = int(os.getenv("LLM_LOCAL_GPU_LAYERS", 0))
+        self.llm_local_chat_format = os.getenv("LLM_LOCAL_CHAT_FORMAT", "")
+        # OpenAI-compatible local LLM server (LM Studio, llama.cpp server, ...)
+        self.llm_api_base = os.getenv("LLM_API_BASE", "http://192.168.1.101:1234/v1")
+        # Comma separated list of servers to load balance across; defaults to LLM_API_BASE
+        self.llm_api_bases = os.getenv("LLM_API_BASES", self.llm_api_base)
+        # Endpoint health: ejection after consecutive failures, active checks of GET /models
+        self.llm_eject_after = int(os.getenv("LLM_EJECT_AFTER", 3))
+        self.llm_eject_duration = float(os.getenv("LLM_EJECT_DURATION", 30))
+        self.llm_health_check_interval = float(os.getenv("LLM_HEALTH_CHECK_INTERVAL", 0))
+        self.llm_health_check_timeout = float(os.getenv("LLM_HEALTH_CHECK_TIMEOUT", 2))
+        # Only send a model to endpoints that report serving it
+        self.llm_model_routing = os.getenv("LLM_MODEL_ROUTING", "True") == 'True'
+        # Keep-alive connection pool shared by every create_chat_completion() caller
+        self.llm_pool_connections = int(os.getenv("LLM_POOL_CONNECTIONS", 4))
+        self.llm_pool_maxsize = int(os.getenv("LLM_POOL_MAXSIZE", 8))
+        # Per-host overrides of the pool size, e.g. "http://10.0.0.2:1234=16,http://10.0.0.3:1234=4"
+        self.llm_pool_sizes = os.getenv("LLM_POOL_SIZES", "")
+        self.llm_connect_timeout = float(os.getenv("LLM_CONNECT_TIMEOUT", 5))
+        self.llm_read_timeout = float(os.getenv("LLM_READ_TIMEOUT", 600))
+        # Retries with exponential backoff and jitter on 429/502/503/504 and timeouts
+        self.llm_max_retries = int(os.getenv("LLM_MAX_RETRIES", 5))
+        self.llm_backoff_base = float(os.getenv("LLM_BACKOFF_BASE", 1))
+        self.llm_backoff_max = float(os.getenv("LLM_BACKOFF_MAX", 30))
+        # Adaptive (AIMD) concurrency limit shared by all LLM callers
+        self.llm_limit_initial = int(os.getenv("LLM_LIMIT_INITIAL", 4))
+        self.llm_limit_min = int(os.getenv("LLM_LIMIT_MIN", 1))
+        self.llm_limit_max = int(os.getenv("LLM_LIMIT_MAX", 16))
+        # Priority scheduling of calls waiting for the limiter: classes as "name=priority:weight"
+        # (lower priority first, weighted fair queuing within a priority) and the class of each call site
+        self.llm_scheduler = os.getenv("LLM_SCHEDULER", "True") == 'True'
+        self.llm_scheduler_classes = os.getenv("LLM_SCHEDULER_CLASSES", "interactive=0:1,agent=1:2,background=1:1")
+        self.llm_scheduler_call_sites = os.getenv(
+            "LLM_SCHEDULER_CALL_SITES",
+            "agent_turn=interactive,json_fix=interactive,ai_function=interactive,sub_agent=agent,summarize=background,"
+            "summarize_history=background")
+        # Persistent cache for deterministic (temperature 0) or opted-in completions
+        self.llm_cache = os.getenv("LLM_CACHE", "False") == 'True'
+        self.llm_cache_path = os.getenv("LLM_CACHE_PATH", "llm_cache.sqlite3")
+        self.llm_cache_max_entries = int(os.getenv("LLM_CACHE_MAX_ENTRIES", 5000))
+        self.llm_cache_max_bytes = int(os.getenv("LLM_CACHE_MAX_BYTES", 50 * 1024 * 1024))
+        self.llm_cache_ttl = float(os.getenv("LLM_CACHE_TTL", 7 * 24 * 3600))
+        # Prefix (KV) cache reuse on llama.cpp-style servers: send cache_prompt and pin
+        # slot_key'd calls, such as agent turns, to a stable slot id out of LLM_SERVER_SLOTS
+        self.llm_cache_prompt = os.getenv("LLM_CACHE_PROMPT", "False") == 'True'
+        self.llm_server_slots = int(os.getenv("LLM_SERVER_SLOTS", 1))
+        # Persist the agent slot's KV state for the system prompt across runs with the server's
+        # slot save/restore API (llama.cpp server started with --slot-save-path)
+        self.llm_slot_save = os.getenv("LLM_SLOT_SAVE", "False") == 'True'
+        # Constrain agent replies to the command JSON schema:
+        # "none", "json_schema" (llama.cpp), "response_format" (OpenAI/LM Studio) or "grammar" (GBNF)
+        self.llm_constrained_decoding = os.getenv("LLM_CONSTRAINED_DECODING", "none")
+        # Route calls between the fast and smart models: per call site, models in order of preference
+        # ("fast"/"smart" or model ids), skipped while their p95 latency (seconds) or error rate is over budget
+        self.llm_router = os.getenv("LLM_ROUTER", "False") == 'True'
+        self.llm_router_policy = os.getenv(
+            "LLM_ROUTER_POLICY",
+            "agent_turn=fast,smart;json_fix=fast,smart;summarize=fast,smart;summarize_history=fast,smart;"
+            "sub_agent=fast,smart;ai_function=smart,fast")
+        self.llm_router_budget = float(os.getenv("LLM_ROUTER_BUDGET", 0))
+        self.llm_router_budgets = os.getenv("LLM_ROUTER_BUDGETS", "")
+        self.llm_router_max_error_rate = float(os.getenv("LLM_ROUTER_MAX_ERROR_RATE", 0.5))
+        self.llm_router_window = float(os.getenv("LLM_ROUTER_WINDOW", 300))
+        # Performance profiles: send model_config's inference params with every request, with
+        # per-task variants (agent_turn, json_fix, summarize, sub_agent, ...) overridable from a JSON file
+        self.llm_send_sampling_params = os.getenv("LLM_SEND_SAMPLING_PARAMS", "True") == 'True'
+        self.llm_profiles_file = os.getenv("LLM_PROFILES_FILE", "")
+        # Per-call latency metrics: Prometheus scrape port (0 = off) and a file ("-" = stdout) to dump them to at exit
+        self.llm_metrics_port = int(os.getenv("LLM_METRICS_PORT", 0))
+        self.llm_metrics_dump = os.getenv("LLM_METRICS_DUMP", "")
+        # Coalesce concurrent identical requests into one upstream call
+        self.llm_singleflight = os.getenv("LLM_SINGLEFLIGHT", "True") == 'True'
+        # Per-call deadline in seconds (0 = none), with per-call-site overrides, e.g. "agent_turn=120,json_fix=30"
+        self.llm_deadline = float(os.getenv("LLM_DEADLINE", 0))
+        self.llm_deadlines = os.getenv("LLM_DEADLINES", "")
+        # Hedged requests: when no token has arrived after the call site's p(LLM_HEDGE_PERCENTILE)
+        # time to first token (LLM_HEDGE_DELAY seconds until there is enough history), send a
+        # copy to another endpoint and keep whichever answers first. Empty call sites = all.
+        self.llm_hedge = os.getenv("LLM_HEDGE", "False") == 'True'
+        self.llm_hedge_percentile = float(os.getenv("LLM_HEDGE_PERCENTILE", 95))
+        self.llm_hedge_delay = float(os.getenv("LLM_HEDGE_DELAY", 10))
+        self.llm_hedge_call_sites = os.getenv("LLM_HEDGE_CALL_SITES", "")
+        # Concurrency limits for acreate_chat_completion
+        self.llm_async_max_concurrency = int(os.getenv("LLM_ASYNC_MAX_CONCURRENCY", 8))
+        self.llm_endpoint_max_concurrency = int(os.getenv("LLM_ENDPOINT_MAX_CONCURRENCY", 4))
+        # Per-endpoint overrides, e.g. "http://10.0.0.2:1234=2"
+        self.llm_endpoint_concurrency = os.getenv("LLM_ENDPOINT_CONCURRENCY", "")
+        # Stream replies (SSE) for agent turns and summaries
+        self.llm_stream = os.getenv("LLM_STREAM", "False") == 'True'
+        # Stream agent turns and cancel generation once the command JSON object is complete
+        self.llm_stop_at_json_end = os.getenv("LLM_STOP_AT_JSON_END", "False") == 'True'
+        # Sample this many agent replies concurrently and keep the first that parses and names a known command
+        self.llm_n_best = int(os.getenv("LLM_N_BEST", 1))
+        # Ask the fast model first and re-ask the smart model only if its reply fails validation
+        self.llm_cascade = os.getenv("LLM_CASCADE", "False") == 'True'
+        # Tokens of retrieved memories per agent turn (0 = what is left of 2500 tokens after the system prompts)
+        self.llm_memory_budget = int(os.getenv("LLM_MEMORY_BUDGET", 0))
+        # Order the agent context from most stable to most volatile (prompt, history, then time, memories and input)
+        # so the server's prefix cache survives from one turn to the next
+        self.llm_stable_context = os.getenv("LLM_STABLE_CONTEXT", "False") == 'True'
+        # Fold history that falls out of the context window into a running summary, made by the fast model
+        # in the background once this many messages have been evicted
+        self.llm_history_summary = os.getenv("LLM_HISTORY_SUMMARY", "False") == 'True'
+        self.llm_history_summary_every = int(os.getenv("LLM_HISTORY_SUMMARY_EVERY", 6))
+        self.llm_history_summary_tokens = int(os.getenv("LLM_HISTORY_SUMMARY_TOKENS", 300))
         self.use_azure = os.getenv("USE_AZURE") == 'True'
         self.execute_local_commands = os.getenv('EXECUTE_LOCAL_COMMANDS', 'True') == 'True'
 
@@ -0,0 +1,105 @@
+import threading
+from config import Config
+from llm_metrics import metrics
+from llm_utils import create_chat_completion, route_model
+from logger import logger
+
+cfg = Config()
+
+# Evicted messages longer than this are cut before they are summarized
+MAX_MESSAGE_CHARS = 2000
+
+SUMMARY_INSTRUCTIONS = (
+    "You maintain the running summary of an autonomous agent's earlier work. "
+    "Update the summary with the new events: keep goals, decisions, results, file names and open problems, "
+    "drop chatter and anything the new events make obsolete. Reply with the updated summary only, "
+    "in at most {words} words.")
+
+
+class RollingSummary:
+    """
+    A bounded running summary of the messages that fell out of the context window.
+
+    chat_with_ai reports where its window starts every turn. Once every
+    messages have been evicted since the last update, they are folded into
+    the summary by the fast model on a background thread, so the agent turn
+    never waits for it. The summary is kept to max_tokens, so the prompt
+    stays short however long the session runs.
+    """
+
+    def __init__(self, every=6, max_tokens=300):
+        """
+        Initialize the RollingSummary class.
+
+        Args:
+        every (int): Number of evicted messages that triggers an update.
+        max_tokens (int): Maximum length of the summary in tokens.
+        """
+        self.every = every
+        self.max_tokens = max_tokens
+        self.summary = ""
+        # Messages before this index of the history are folded into the summary
+        self.summarized_until = 0
+        self._lock = threading.Lock()
+        self._running = False
+
+    def message(self):
+        """
+        Return the summary as a system message.
+
+        Returns:
+        tuple: The system message, or None while there is no summary, and the
+            index of the first history message the summary does not cover.
+        """
+        with self._lock:
+            summary, summarized_until = self.summary, self.summarized_until
+        if not summary:
+            return None, 0
+        return {"role": "system", "content": f"Summary of your earlier work:\n{summary}"}, summarized_until
+
+    def update(self, history, window_start: int) -> None:
+        """
+        Start folding evicted messages into the summary if enough have piled up.
+
+        Args:
+        history (list): The full message history.
+        window_start (int): Index of the oldest message still in the context window.
+        """
+        with self._lock:
+            if self._running or window_start - self.summarized_until < self.every:
+                return
+            self._running = True
+            start = self.summarized_until
+            # Fold at most a few batches at a time so the request stays small
+            end = min(window_start, start + 4 * self.every)
+            evicted = list(history[start:end])
+            summary = self.summary
+        threading.Thread(target=self._fold, args=(summary, evicted, end), name="history-summary", daemon=True).start()
+
+    def _fold(self, summary, evicted, end) -> None:
+        events = "\n".join(
+            f"{message['role']}: {message['content'][:MAX_MESSAGE_CHARS]}" for message in evicted)
+        messages = [
+            {"role": "system", "content": SUMMARY_INSTRUCTIONS.format(words=int(self.max_tokens * 0.75))},
+            {"role": "user", "content": f"Current summary:\n{summary or '(none)'}\n\nNew events:\n{events}"},
+        ]
+        try:
+            updated = create_chat_completion(
+                messages,
+                model=route_model("summarize_history", cfg.fast_llm_model),
+                max_tokens=self.max_tokens,
+                call_site="summarize_history",
+            )
+        except Exception as e:
+            # Keep the old summary; the same messages are folded on the next turn
+            logger.debug(f"History summary update failed: {e}")
+            metrics.incr("llm_history_summary_failures")
+            with self._lock:
+                self._running = False
+            return
+        with self._lock:
+            self.summary = updated.strip()
+            self.summarized_until = end
+            self._running = False
+        metrics.incr("llm_history_summary_updates")
+        metrics.set_gauge("llm_history_summarized_messages", end)
@@ -0,0 +1,87 @@
+import json
+import re
+
+# Shared GBNF rules for JSON primitives
+PRIMITIVE_RULES = {
+    "ws": '| " " | "\\n" [ \\t]{0,20}',
+    "string": '"\\"" ( [^"\\\\\\x7F\\x00-\\x1F] | "\\\\" ( ["\\\\/bfnrt] | "u" [0-9a-fA-F]{4} ) )* "\\"" ws',
+    "number": '"-"? ( [0] | [1-9] [0-9]{0,15} ) ( "." [0-9]+ )? ( [eE] [-+]? [0-9]+ )? ws',
+    "boolean": '( "true" | "false" ) ws',
+    "null": '"null" ws',
+}
+
+
+def _literal(value) -> str:
+    """Return a GBNF literal matching the JSON encoding of value"""
+    return json.dumps(json.dumps(value))
+
+
+def _rule_name(name: str) -> str:
+    return re.sub(r"[^a-zA-Z0-9-]+", "-", name)
+
+
+class _GrammarBuilder:
+    """Converts the subset of JSON schema produced by PromptGenerator into GBNF rules"""
+
+    def __init__(self):
+        self.rules = {}
+
+    def visit(self, schema: dict, name: str) -> str:
+        """Return a GBNF expression for schema, adding named rules as needed"""
+        if "const" in schema:
+            return f"{_literal(schema['const'])} ws"
+        if "enum" in schema:
+            return "( " + " | ".join(f"{_literal(value)}" for value in schema["enum"]) + " ) ws"
+        if "anyOf" in schema or "oneOf" in schema:
+            alternatives = schema.get("anyOf") or schema.get("oneOf")
+            return self._add(name, " | ".join(
+                self.visit(alternative, f"{name}-{i}") for i, alternative in enumerate(alternatives)))
+        schema_type = schema.get("type")
+        if schema_type == "object":
+            return self._add(name, self._object(schema, name))
+        if schema_type == "array":
+            item = self.visit(schema.get("items", {"type": "string"}), f"{name}-item")
+            return self._add(name, f'"[" ws ( {item} ( "," ws {item} )* )? "]" ws')
+        if schema_type in ("string", "number", "boolean", "null"):
+            return schema_type
+        if schema_type == "integer":
+            return "number"
+        raise ValueError(f"Unsupported JSON schema for grammar generation: {schema}")
+
+    def _object(self, schema: dict, name: str) -> str:
+        properties = schema.get("properties", {})
+        if not properties:
+            return '"{" ws "}" ws'
+        # Properties are emitted in schema order; every property is required
+        members = [
+            f'{_literal(key)} ws ":" ws {self.visit(value, f"{name}-{key}")}'
+            for key, value in properties.items()
+        ]
+        return '"{" ws ' + ' "," ws '.join(members) + ' "}" ws'
+
+    def _add(self, name: str, body: str) -> str:
+        rule = _rule_name(name)
+        self.rules[rule] = body
+        return rule
+
+
+def schema_to_gbnf(schema: dict) -> str:
+    """
+    Convert a JSON schema into a GBNF grammar for llama.cpp-style servers.
+
+    Supports objects (properties in order, all required), arrays, strings,
+    numbers, booleans, null, const, enum and anyOf/oneOf.
+
+    Args:
+        schema (dict): The JSON schema.
+
+    Returns:
+        str: The grammar, with "root" as the start rule.
+    """
+    builder = _GrammarBuilder()
+    root = builder.visit(schema, "root")
+    if root != "root":
+        builder.rules["root"] = root
+    rules = dict(builder.rules)
+    rules.update(PRIMITIVE_RULES)
+    return "\n".join(f"{name} ::= {body}" for name, body in rules.items()) + "\n"
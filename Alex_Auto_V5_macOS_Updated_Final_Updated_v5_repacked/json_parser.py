@@ -3,6 +3,7 @@ from typing import Any, Dict, Union
 from call_ai_function import call_ai_function
 from config import Config
 from json_utils import correct_json
+from llm_utils import route_model
 from logger import logger
 
 cfg = Config()
@@ -90,7 +91,8 @@ def fix_json(json_str: str, schema: str) -> str:
     if not json_str.startswith("`"):
         json_str = "```json\n" + json_str + "\n```"
     result_string = call_ai_function(
-        function_string, args, description_string, model=cfg.fast_llm_model
+        function_string, args, description_string, model=route_model("json_fix", cfg.fast_llm_model),
+        call_site="json_fix"
     )
     logger.debug("------------ JSON FIX ATTEMPT ---------------")
     logger.debug(f"Original JSON: {json_str}")
@@ -130,6 +130,59 @@ def correct_json(json_str: str) -> str:
             return balanced_str
     return json_str
 
+
+class JsonObjectTracker:
+    """
+    Incrementally tracks brace and string state of streamed text to detect
+    when the first top-level JSON object is complete.
+
+    Text before the first "{" (such as a ```json fence) is skipped.
+    """
+
+    def __init__(self):
+        """Initialize the JsonObjectTracker class"""
+        self.position = 0
+        self.depth = 0
+        self.started = False
+        self.in_string = False
+        self.escaped = False
+        self.end = None
+
+    def feed(self, text: str):
+        """
+        Consume the next piece of text.
+
+        Args:
+            text (str): The next delta of the stream.
+
+        Returns:
+            int: The offset in the whole stream just past the closing brace of
+              the top-level object, or None if it isn't complete yet.
+        """
+        if self.end is not None:
+            return self.end
+        for i, char in enumerate(text):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                if self.started:
+                    self.in_string = True
+            elif char == '{':
+                self.started = True
+                self.depth += 1
+            elif char == '}' and self.started:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.end = self.position + i + 1
+                    break
+        self.position += len(text)
+        return self.end
+
 # Modified for enhanced functionality
 
 # Modified for enhanced functionality
@@ -0,0 +1,122 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from llm_metrics import metrics
+
+
+def cache_key(payload: dict) -> str:
+    """
+    Return the content address of a completion request.
+
+    Args:
+    payload (dict): The request body (model, messages, temperature, max_tokens and sampling params).
+
+    Returns:
+    str: A sha256 hex digest of the canonical JSON encoding of payload.
+    """
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class CompletionCache:
+    """
+    Persistent completion cache backed by SQLite.
+
+    Entries are evicted least-recently-used first once the cache holds more
+    than max_entries rows or max_bytes of content, and expire after ttl
+    seconds. SQLite's WAL journal and busy timeout make the file safe to
+    share between concurrent processes.
+    """
+
+    def __init__(self, path, max_entries=5000, max_bytes=50 * 1024 * 1024, ttl=7 * 24 * 3600):
+        """Initialize the CompletionCache class"""
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS completions ("
+                " key TEXT PRIMARY KEY,"
+                " value TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " created REAL NOT NULL,"
+                " accessed REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS completions_accessed ON completions (accessed)")
+
+    def _connect(self) -> sqlite3.Connection:
+        # sqlite3 connections can't be shared between threads, so keep one per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str):
+        """Return the cached completion for key, or None on a miss"""
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT value, created FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl and now - row[1] > self.ttl:
+                conn.execute("DELETE FROM completions WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                metrics.incr("llm_cache_misses")
+                return None
+            conn.execute("UPDATE completions SET accessed = ? WHERE key = ?", (now, key))
+        metrics.incr("llm_cache_hits")
+        return row[0]
+
+    def put(self, key: str, value: str) -> None:
+        """Store a completion and evict entries beyond the configured bounds"""
+        now = time.time()
+        size = len(value.encode("utf-8"))
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO completions (key, value, size, created, accessed)"
+                " VALUES (?, ?, ?, ?, ?)", (key, value, size, now, now))
+            self._evict(conn, now)
+
+    def _evict(self, conn: sqlite3.Connection, now: float) -> None:
+        if self.ttl:
+            conn.execute("DELETE FROM completions WHERE created < ?", (now - self.ttl,))
+        count, total = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completions").fetchone()
+        excess = count - self.max_entries
+        if excess > 0:
+            conn.execute(
+                "DELETE FROM completions WHERE key IN"
+                " (SELECT key FROM completions ORDER BY accessed ASC LIMIT ?)", (excess,))
+            metrics.incr("llm_cache_evictions", excess)
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+        while total > self.max_bytes:
+            row = conn.execute(
+                "SELECT key, size FROM completions ORDER BY accessed ASC LIMIT 1").fetchone()
+            if row is None:
+                break
+            conn.execute("DELETE FROM completions WHERE key = ?", (row[0],))
+            metrics.incr("llm_cache_evictions")
+            total -= row[1]
+
+    def clear(self) -> None:
+        """Remove every cached completion"""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM completions")
+
+    def stats(self) -> dict:
+        """Return hit/miss counts and the current size of the cache"""
+        with self._connect() as conn:
+            count, total = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completions").fetchone()
+        return {
+            "hits": metrics.get("llm_cache_hits"),
+            "misses": metrics.get("llm_cache_misses"),
+            "evictions": metrics.get("llm_cache_evictions"),
+            "entries": count,
+            "bytes": total,
+        }
@@ -0,0 +1,197 @@
+import threading
+import time
+from llm_metrics import metrics
+
+
+class Endpoint:
+    """
+    One OpenAI-compatible server.
+
+    Attributes:
+        url: The base url, e.g. "http://10.0.0.2:1234/v1".
+        outstanding: Number of requests currently sent to this endpoint.
+        healthy: False while the endpoint is ejected.
+        models: Model ids reported by GET /models, or None if unknown.
+    """
+
+    def __init__(self, url: str):
+        """Initialize the Endpoint class"""
+        self.url = url.rstrip("/")
+        self.outstanding = 0
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.ejected_at = None
+        self.models = None
+
+    def serves(self, model) -> bool:
+        """Return True unless the endpoint is known not to serve model"""
+        return model is None or self.models is None or model in self.models
+
+    def __repr__(self):
+        return f"Endpoint({self.url!r}, outstanding={self.outstanding}, healthy={self.healthy})"
+
+
+class EndpointPool:
+    """
+    Routes requests across several endpoints by least outstanding requests.
+
+    An endpoint is ejected after eject_after consecutive failures (connection
+    errors, timeouts and server errors, not overload responses) and
+    re-admitted when an active health check succeeds, or after eject_duration
+    seconds when no health checker is running.
+    """
+
+    def __init__(self, urls, eject_after=3, eject_duration=30.0, model_routing=True):
+        """Initialize the EndpointPool class"""
+        if not urls:
+            raise ValueError("At least one LLM endpoint is required")
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.eject_after = eject_after
+        self.eject_duration = eject_duration
+        self.model_routing = model_routing
+        self._lock = threading.Lock()
+        self._turn = 0
+        self._checker = None
+        self._stop = threading.Event()
+
+    def get(self, url: str) -> Endpoint:
+        """Return the endpoint with the given base url"""
+        url = url.rstrip("/")
+        for endpoint in self.endpoints:
+            if endpoint.url == url:
+                return endpoint
+        raise KeyError(url)
+
+    def candidates(self, model=None, exclude=()):
+        """
+        Return the endpoints a request for model may be sent to.
+
+        Prefers healthy endpoints serving the model, then any healthy endpoint,
+        then every endpoint, so a request is never refused outright.
+        """
+        with self._lock:
+            self._readmit_expired()
+            pool = [e for e in self.endpoints if e not in exclude] or list(self.endpoints)
+            healthy = [e for e in pool if e.healthy]
+            if self.model_routing and model is not None:
+                serving = [e for e in healthy if e.serves(model)]
+                if serving:
+                    return serving
+            return healthy or pool
+
+    def acquire(self, model=None, preferred=None, exclude=()) -> Endpoint:
+        """Pick the least loaded candidate (or preferred, if it's one) and count the request"""
+        candidates = self.candidates(model, exclude)
+        with self._lock:
+            if preferred is not None and preferred in candidates:
+                endpoint = preferred
+            else:
+                # Ties go round-robin, so under light load the traffic is not all sent to the first endpoint
+                least = min(e.outstanding for e in candidates)
+                tied = [e for e in candidates if e.outstanding == least]
+                endpoint = tied[self._turn % len(tied)]
+                self._turn += 1
+            endpoint.outstanding += 1
+            self._publish(endpoint)
+        return endpoint
+
+    def release(self, endpoint: Endpoint, failed=False) -> None:
+        """Finish a request and record whether the endpoint failed it"""
+        with self._lock:
+            endpoint.outstanding = max(0, endpoint.outstanding - 1)
+            if failed:
+                self._record_failure(endpoint)
+            else:
+                endpoint.consecutive_failures = 0
+            self._publish(endpoint)
+
+    def mark_healthy(self, endpoint: Endpoint, models=None) -> None:
+        """Re-admit an endpoint after a successful health check"""
+        with self._lock:
+            if not endpoint.healthy:
+                metrics.incr("llm_endpoint_readmissions")
+            endpoint.healthy = True
+            endpoint.consecutive_failures = 0
+            endpoint.ejected_at = None
+            if models is not None:
+                endpoint.models = set(models)
+            self._publish(endpoint)
+
+    def mark_failed(self, endpoint: Endpoint) -> None:
+        """Record a failed health check"""
+        with self._lock:
+            self._record_failure(endpoint)
+            self._publish(endpoint)
+
+    def start_health_checks(self, probe, interval: float) -> None:
+        """
+        Probe every endpoint every interval seconds on a daemon thread.
+
+        Args:
+        probe (callable): Called with an Endpoint; returns the list of served
+            model ids (or None) and raises if the endpoint is unhealthy.
+        interval (float): Seconds between rounds of checks.
+        """
+        if self._checker is not None or interval <= 0:
+            return
+
+        def run():
+            while not self._stop.is_set():
+                self.check_all(probe)
+                self._stop.wait(interval)
+
+        self._checker = threading.Thread(target=run, name="llm-health", daemon=True)
+        self._checker.start()
+
+    def stop_health_checks(self) -> None:
+        """Stop the health check thread"""
+        self._stop.set()
+        if self._checker is not None:
+            self._checker.join()
+            self._checker = None
+        self._stop.clear()
+
+    def check_all(self, probe) -> None:
+        """Run one round of health checks"""
+        for endpoint in self.endpoints:
+            try:
+                models = probe(endpoint)
+            except Exception:
+                self.mark_failed(endpoint)
+            else:
+                self.mark_healthy(endpoint, models)
+
+    def stats(self) -> list:
+        """Return the state of every endpoint"""
+        with self._lock:
+            return [{
+                "url": e.url,
+                "outstanding": e.outstanding,
+                "healthy": e.healthy,
+                "consecutive_failures": e.consecutive_failures,
+                "models": sorted(e.models) if e.models is not None else None,
+            } for e in self.endpoints]
+
+    def _record_failure(self, endpoint: Endpoint) -> None:
+        endpoint.consecutive_failures += 1
+        if endpoint.healthy and endpoint.consecutive_failures >= self.eject_after:
+            endpoint.healthy = False
+            endpoint.ejected_at = time.monotonic()
+            metrics.incr("llm_endpoint_ejections")
+
+    def _readmit_expired(self) -> None:
+        # Without active health checks, give ejected endpoints another chance
+        # once eject_duration has passed
+        if self._checker is not None:
+            return
+        now = time.monotonic()
+        for endpoint in self.endpoints:
+            if not endpoint.healthy and now - endpoint.ejected_at >= self.eject_duration:
+                endpoint.healthy = True
+                endpoint.consecutive_failures = 0
+                endpoint.ejected_at = None
+                metrics.incr("llm_endpoint_readmissions")
+
+    def _publish(self, endpoint: Endpoint) -> None:
+        metrics.set_gauge(f"llm_endpoint_outstanding[{endpoint.url}]", endpoint.outstanding)
+        metrics.set_gauge(f"llm_endpoint_healthy[{endpoint.url}]", int(endpoint.healthy))
@@ -0,0 +1,157 @@
+import collections
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from llm_metrics import metrics
+
+
+class AdaptiveLimiter:
+    """
+    AIMD (additive increase, multiplicative decrease) concurrency limiter.
+
+    Every successful call raises the limit by roughly one slot per window of
+    calls; an overload signal (429/502/503/timeout) multiplies it by
+    decrease_factor, at most once per cooldown so a burst of failures from the
+    same overload only counts once.
+    """
+
+    def __init__(self, initial_limit=4, min_limit=1, max_limit=16,
+                 decrease_factor=0.5, cooldown=1.0, window=100, name="llm_limiter", scheduler=None):
+        """
+        Initialize the AdaptiveLimiter class.
+
+        scheduler, if given, is a PriorityScheduler deciding which waiting
+        caller gets the next free slot; otherwise waiters race for it.
+        """
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+        self.name = name
+        self.scheduler = scheduler
+        self.inflight = 0
+        self._last_decrease = 0.0
+        self._outcomes = collections.deque(maxlen=window)
+        self._condition = threading.Condition()
+        self._publish()
+
+    def acquire(self, timeout=None, call_site=None) -> bool:
+        """
+        Wait for a free slot.
+
+        Args:
+        timeout (float, optional): Maximum number of seconds to wait.
+        call_site (str, optional): Decides the caller's place in the queue when
+            a scheduler is set.
+
+        Returns:
+        bool: True if a slot was acquired, False on timeout.
+        """
+        with self._condition:
+            if self.scheduler is None:
+                acquired = self._condition.wait_for(
+                    lambda: self.inflight < int(self.limit), timeout)
+            else:
+                ticket = self.scheduler.enqueue(call_site)
+                acquired = self._condition.wait_for(
+                    lambda: self.inflight < int(self.limit) and self.scheduler.is_next(ticket), timeout)
+                self.scheduler.dequeue(ticket, granted=acquired)
+                # The next caller in line may be able to go as well
+                self._condition.notify_all()
+            if acquired:
+                self.inflight += 1
+            else:
+                metrics.incr(f"{self.name}_queue_timeouts")
+            self._publish()
+            return acquired
+
+    def release(self, overloaded=False, success=True) -> None:
+        """
+        Return a slot and adjust the limit.
+
+        Args:
+        overloaded (bool): The server signalled overload (429/502/503/timeout).
+        success (bool): The call succeeded. Calls that neither succeeded nor
+            overloaded (e.g. a 400) leave the limit unchanged.
+        """
+        with self._condition:
+            self.inflight = max(0, self.inflight - 1)
+            if overloaded:
+                self._outcomes.append(False)
+                metrics.incr(f"{self.name}_rejects")
+                now = time.monotonic()
+                if now - self._last_decrease >= self.cooldown:
+                    self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                    self._last_decrease = now
+            elif success:
+                self._outcomes.append(True)
+                metrics.incr(f"{self.name}_successes")
+                self.limit = min(self.max_limit, self.limit + 1.0 / max(self.limit, 1.0))
+            self._publish()
+            self._condition.notify_all()
+
+    def reject_rate(self) -> float:
+        """Return the share of overloaded calls among the most recent outcomes"""
+        with self._condition:
+            if not self._outcomes:
+                return 0.0
+            return self._outcomes.count(False) / len(self._outcomes)
+
+    def stats(self) -> dict:
+        """Return the current limit, in-flight count, recent reject rate and queue depth per class"""
+        stats = {
+            "limit": int(self.limit),
+            "inflight": self.inflight,
+            "reject_rate": self.reject_rate(),
+        }
+        if self.scheduler is not None:
+            with self._condition:
+                stats["queued"] = self.scheduler.stats()
+        return stats
+
+    def _publish(self) -> None:
+        metrics.set_gauge(f"{self.name}_limit", int(self.limit))
+        metrics.set_gauge(f"{self.name}_inflight", self.inflight)
+        if self._outcomes:
+            metrics.set_gauge(f"{self.name}_reject_rate",
+                              self._outcomes.count(False) / len(self._outcomes))
+
+
+def parse_retry_after(value):
+    """
+    Parse a Retry-After header.
+
+    Args:
+    value (str): Either a number of seconds or an HTTP date.
+
+    Returns:
+    float: Seconds to wait, or None if the header is missing or malformed.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def backoff_delay(attempt, base=1.0, cap=30.0, retry_after=None) -> float:
+    """
+    Return how long to sleep before the next retry.
+
+    A server-provided Retry-After wins (capped at cap); otherwise this is
+    exponential backoff with full jitter: uniform(0, min(cap, base * 2**attempt)).
+    """
+    if retry_after is not None:
+        return min(cap, retry_after)
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
@@ -0,0 +1,138 @@
+import threading
+from config import Config, model_config
+
+try:
+    from llama_cpp import Llama, LlamaGrammar
+except ImportError:
+    Llama = None
+    LlamaGrammar = None
+
+cfg = Config()
+
+# model_config inference params and the llama-cpp-python sampling arguments they map to
+SAMPLING_PARAMS = {
+    "top_k": "top_k",
+    "top_p": "top_p",
+    "repeat_penalty": "repeat_penalty",
+    "tfs_z": "tfs_z",
+    "typical_p": "typical_p",
+    "frequency_penalty": "frequency_penalty",
+    "presence_penalty": "presence_penalty",
+    "mirostat": "mirostat_mode",
+    "mirostat_tau": "mirostat_tau",
+    "mirostat_eta": "mirostat_eta",
+}
+
+
+class LocalBackend:
+    """
+    Runs a GGUF model in-process with llama-cpp-python.
+
+    The model is loaded with the load_params and inference_params of
+    model_config and answers OpenAI-shaped chat completion payloads, so
+    llm_utils can use it in place of an HTTP server. A llama.cpp context
+    serves one request at a time, so calls are serialized; a stream holds
+    the model until it is exhausted or closed.
+    """
+
+    def __init__(self, model_path: str, load_params: dict, inference_params: dict, n_gpu_layers=0, chat_format=None):
+        """Initialize the LocalBackend class"""
+        if Llama is None:
+            raise ImportError("llama-cpp-python is not installed. Please install it to use LLM_BACKEND=local.")
+        if not model_path:
+            raise ValueError("LLM_MODEL_PATH must point to a GGUF model to use LLM_BACKEND=local")
+        self.inference_params = inference_params
+        seed = load_params.get("seed", -1)
+        kwargs = {
+            "model_path": model_path,
+            "n_ctx": load_params.get("n_ctx", 4096),
+            "n_batch": load_params.get("n_batch", 512),
+            "n_threads": inference_params.get("n_threads"),
+            "n_gpu_layers": n_gpu_layers,
+            "use_mmap": load_params.get("use_mmap", True),
+            "use_mlock": load_params.get("use_mlock", False),
+            "verbose": False,
+        }
+        if seed is not None and seed >= 0:
+            kwargs["seed"] = seed
+        if load_params.get("rope_freq_base"):
+            kwargs["rope_freq_base"] = load_params["rope_freq_base"]
+        if load_params.get("rope_freq_scale"):
+            kwargs["rope_freq_scale"] = load_params["rope_freq_scale"]
+        if chat_format:
+            kwargs["chat_format"] = chat_format
+        self.model = Llama(**kwargs)
+        self._lock = threading.Lock()
+
+    def _arguments(self, payload: dict) -> dict:
+        # The payload carries the call site's profile (llm_profiles.apply_profile); model_config fills the gaps
+        arguments = {
+            target: payload.get(source, self.inference_params.get(source))
+            for source, target in SAMPLING_PARAMS.items() if source in payload or source in self.inference_params
+        }
+        arguments["messages"] = payload["messages"]
+        arguments["temperature"] = payload.get("temperature", self.inference_params.get("temp", 0.8))
+        max_tokens = payload.get("max_tokens")
+        if max_tokens is None and self.inference_params.get("n_predict", -1) > 0:
+            max_tokens = self.inference_params["n_predict"]
+        arguments["max_tokens"] = max_tokens
+        if payload.get("stop"):
+            arguments["stop"] = payload["stop"]
+        # Constraints added by llm_utils.constrain_payload
+        if payload.get("grammar"):
+            arguments["grammar"] = LlamaGrammar.from_string(payload["grammar"], verbose=False)
+        elif payload.get("json_schema"):
+            arguments["response_format"] = {"type": "json_object", "schema": payload["json_schema"]}
+        elif (payload.get("response_format") or {}).get("type") == "json_schema":
+            schema = payload["response_format"]["json_schema"].get("schema")
+            arguments["response_format"] = {"type": "json_object", "schema": schema}
+        return arguments
+
+    def create_chat_completion(self, payload: dict) -> dict:
+        """
+        Answer a chat completion payload.
+
+        Args:
+        payload (dict): The same body llm_utils would POST to /chat/completions.
+
+        Returns:
+        dict: An OpenAI-style chat completion response.
+        """
+        arguments = self._arguments(payload)
+        with self._lock:
+            return self.model.create_chat_completion(**arguments)
+
+    def stream_chat_completion(self, payload: dict, cancelled=None):
+        """
+        Answer a chat completion payload, yielding OpenAI-style chunks as they are generated.
+
+        cancelled, if given, is a threading.Event checked once the model is free
+        and between chunks; generation stops as soon as it is set.
+        """
+        arguments = self._arguments(payload)
+        with self._lock:
+            if cancelled is not None and cancelled.is_set():
+                return
+            for chunk in self.model.create_chat_completion(stream=True, **arguments):
+                if cancelled is not None and cancelled.is_set():
+                    return
+                yield chunk
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_local_backend() -> LocalBackend:
+    """Return the process-wide LocalBackend, loading the model on first use"""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = LocalBackend(
+                    cfg.llm_model_path,
+                    model_config["load_params"],
+                    model_config["inference_params"],
+                    n_gpu_layers=cfg.llm_local_gpu_layers,
+                    chat_format=cfg.llm_local_chat_format or None)
+    return _backend
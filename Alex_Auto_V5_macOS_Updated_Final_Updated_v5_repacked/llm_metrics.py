@@ -0,0 +1,266 @@
+import collections
+import http.server
+import re
+import threading
+import time
+from config import Singleton
+
+
+class Histogram:
+    """
+    Keeps count, sum and a bounded window of recent samples for percentiles.
+    """
+
+    def __init__(self, window=2048):
+        """Initialize the Histogram class"""
+        self.count = 0
+        self.total = 0.0
+        self.samples = collections.deque(maxlen=window)
+
+    def observe(self, value: float) -> None:
+        """Record one sample"""
+        self.count += 1
+        self.total += value
+        self.samples.append(value)
+
+    def percentile(self, q: float) -> float:
+        """Return the q-th percentile (0-100) of the recent samples"""
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, max(0, int(round(q / 100 * (len(ordered) - 1)))))
+        return ordered[index]
+
+    def summary(self) -> dict:
+        """Return count, sum and p50/p95/p99"""
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+        }
+
+
+class LLMMetrics(metaclass=Singleton):
+    """
+    Thread-safe, in-process counters and gauges shared by every LLM caller.
+    """
+
+    def __init__(self):
+        """Initialize the LLMMetrics class"""
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def incr(self, name: str, value: int = 1) -> None:
+        """Increment the counter called name by value."""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name: str, value) -> None:
+        """Set the gauge called name to value."""
+        with self._lock:
+            self.gauges[name] = value
+
+    def observe(self, name: str, value: float) -> None:
+        """Add a sample to the histogram called name."""
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def histogram_summary(self, name: str = None) -> dict:
+        """Return count, sum and p50/p95/p99 of one histogram, or of all histograms by name."""
+        with self._lock:
+            if name is not None:
+                histogram = self.histograms.get(name)
+                return histogram.summary() if histogram else {}
+            return {key: histogram.summary() for key, histogram in self.histograms.items()}
+
+    def percentile(self, name: str, q: float, min_samples: int = 1):
+        """Return the q-th percentile of a histogram, or None if it has fewer than min_samples samples."""
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None or len(histogram.samples) < min_samples:
+                return None
+            return histogram.percentile(q)
+
+    def get(self, name: str, default=0):
+        """Return the current value of a counter or gauge."""
+        with self._lock:
+            if name in self.counters:
+                return self.counters[name]
+            return self.gauges.get(name, default)
+
+    def snapshot(self) -> dict:
+        """Return a copy of all counters and gauges."""
+        with self._lock:
+            snapshot = dict(self.counters)
+            snapshot.update(self.gauges)
+        return snapshot
+
+    def reset(self) -> None:
+        """Clear all counters, gauges and histograms."""
+        with self._lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+    def render_text(self) -> str:
+        """Return a human-readable dump of every counter, gauge and histogram."""
+        lines = [f"{name} = {value}" for name, value in sorted(self.snapshot().items())]
+        for name, summary in sorted(self.histogram_summary().items()):
+            lines.append(
+                f"{name}: count={summary['count']} p50={summary['p50']:.3f} "
+                f"p95={summary['p95']:.3f} p99={summary['p99']:.3f}")
+        return "\n".join(lines) + "\n"
+
+    def render_prometheus(self) -> str:
+        """Return every metric in the Prometheus text exposition format."""
+        lines = []
+        for name, value in sorted(self.snapshot().items()):
+            if isinstance(value, (int, float)):
+                lines.append(f"{_prometheus_name(name)} {value}")
+        for name, summary in sorted(self.histogram_summary().items()):
+            base, labels = _split_labels(name)
+            for quantile in ("p50", "p95", "p99"):
+                quantile_labels = labels + [f'quantile="0.{quantile[1:]}"']
+                lines.append(f"{base}{{{','.join(quantile_labels)}}} {summary[quantile]}")
+            suffix = f"{{{','.join(labels)}}}" if labels else ""
+            lines.append(f"{base}_sum{suffix} {summary['sum']}")
+            lines.append(f"{base}_count{suffix} {summary['count']}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape_label_value(value: str) -> str:
+    """Escape a label value for the Prometheus text format"""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _split_labels(name: str):
+    """Split "name[site=a,b]" into ("name", ['site="a"', 'label1="b"'])"""
+    match = re.fullmatch(r"([^\[]+)\[(.*)\]", name, re.DOTALL)
+    if not match:
+        return re.sub(r"[^a-zA-Z0-9_:]", "_", name), []
+    labels = []
+    for i, value in enumerate(match.group(2).split(",")):
+        key, _, labelled = value.partition("=")
+        if labelled:
+            key = re.sub(r"[^a-zA-Z0-9_]", "_", key)
+            labels.append(f'{key}="{_escape_label_value(labelled)}"')
+        else:
+            labels.append(f'label{i or ""}="{_escape_label_value(value)}"')
+    return re.sub(r"[^a-zA-Z0-9_:]", "_", match.group(1)), labels
+
+
+def _prometheus_name(name: str) -> str:
+    base, labels = _split_labels(name)
+    return f"{base}{{{','.join(labels)}}}" if labels else base
+
+
+metrics = LLMMetrics()
+
+
+class CallRecord:
+    """
+    Latency and throughput figures for one LLM call, published to the
+    histogram registry under the call site's name when finished.
+
+    Callables in CallRecord.listeners are called with the record and its
+    wall time whenever a call finishes.
+    """
+
+    listeners = []
+
+    def __init__(self, call_site: str, model=None):
+        """Start timing a call"""
+        self.call_site = call_site or "other"
+        self.model = model
+        self.started_at = time.monotonic()
+        self.time_to_first_token = None
+        self.retries = 0
+        self.status = None
+        self.endpoint = None
+        self.prompt_tokens = None
+        self.completion_tokens = None
+        self.finished = False
+        # Set while a hedge answers in this call's place; finish() waits for finish_as() then
+        self.superseded = False
+
+    def first_token(self) -> None:
+        """Mark the arrival of the first streamed token"""
+        if self.time_to_first_token is None:
+            self.time_to_first_token = time.monotonic() - self.started_at
+
+    def finish(self, usage=None, status=None) -> None:
+        """Publish the call's wall time, TTFT, token counts, tokens/sec, retries and status"""
+        if self.finished or self.superseded:
+            return
+        self.finished = True
+        if status is not None:
+            self.status = status
+        wall_time = time.monotonic() - self.started_at
+        usage = usage or {}
+        self.prompt_tokens = usage.get("prompt_tokens", self.prompt_tokens)
+        self.completion_tokens = usage.get("completion_tokens", self.completion_tokens)
+        for listener in CallRecord.listeners:
+            listener(self, wall_time)
+        site = f"call_site={self.call_site}"
+        metrics.incr(f"llm_calls[{site},status={self.status}]")
+        metrics.incr(f"llm_call_retries[{site}]", self.retries)
+        metrics.observe(f"llm_call_seconds[{site}]", wall_time)
+        if self.time_to_first_token is not None:
+            metrics.observe(f"llm_time_to_first_token_seconds[{site}]", self.time_to_first_token)
+        if self.prompt_tokens is not None:
+            metrics.observe(f"llm_prompt_tokens[{site}]", self.prompt_tokens)
+        if self.completion_tokens:
+            metrics.observe(f"llm_completion_tokens[{site}]", self.completion_tokens)
+            decode_time = wall_time - (self.time_to_first_token or 0)
+            if decode_time > 0:
+                metrics.observe(f"llm_tokens_per_second[{site}]", self.completion_tokens / decode_time)
+
+    def finish_as(self, other, usage=None) -> None:
+        """
+        Finish with the outcome of other, a hedge that answered in this call's place.
+
+        The wall time (and time to first token) stay measured from this call's
+        start, which is what the caller waited.
+        """
+        self.superseded = False
+        if other.time_to_first_token is not None and self.time_to_first_token is None:
+            self.time_to_first_token = other.started_at + other.time_to_first_token - self.started_at
+        self.endpoint = other.endpoint
+        self.finish(usage, status=other.status)
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = metrics.render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port: int, host: str = "127.0.0.1"):
+    """Serve the registry in Prometheus format on a daemon thread and return the server"""
+    server = http.server.ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="llm-metrics", daemon=True).start()
+    return server
+
+
+def dump_metrics(path: str) -> None:
+    """Write the registry to path, or to stdout if path is "-"."""
+    text = metrics.render_text()
+    if path == "-":
+        print(text)
+    else:
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(text)
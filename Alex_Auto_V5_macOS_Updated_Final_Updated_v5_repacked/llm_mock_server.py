@@ -0,0 +1,413 @@
+import argparse
+import hashlib
+import http.server
+import itertools
+import json
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+# Served when no scripted or recorded reply applies: a valid agent turn
+DEFAULT_REPLY = json.dumps({
+    "thoughts": {
+        "text": "Nothing to do yet.",
+        "reasoning": "This is a reply from the mock server.",
+        "plan": "- wait",
+        "criticism": "",
+        "speak": "Nothing to do yet.",
+    },
+    "command": {"name": "do_nothing", "args": {}},
+})
+
+
+def parse_latency(spec: str):
+    """
+    Parse a latency distribution.
+
+    Args:
+    spec (str): "fixed:s", "uniform:low,high", "normal:mean,stddev",
+        "lognormal:mu,sigma" or "exponential:mean", in seconds.
+
+    Returns:
+    callable: Draws a latency in seconds (never negative) from a random.Random.
+    """
+    kind, _, values = (spec or "fixed:0").partition(":")
+    params = [float(value) for value in values.split(",") if value.strip()]
+    if kind == "fixed":
+        return lambda rng: params[0] if params else 0.0
+    if kind == "uniform":
+        return lambda rng: rng.uniform(params[0], params[1])
+    if kind == "normal":
+        return lambda rng: max(0.0, rng.gauss(params[0], params[1]))
+    if kind == "lognormal":
+        return lambda rng: rng.lognormvariate(params[0], params[1])
+    if kind == "exponential":
+        return lambda rng: rng.expovariate(1.0 / params[0]) if params[0] > 0 else 0.0
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+def parse_errors(spec: str) -> dict:
+    """
+    Parse error injection rates.
+
+    Args:
+    spec (str): Comma separated "kind=rate" entries, where kind is an HTTP
+        status code or "timeout", e.g. "429=0.05,502=0.02,timeout=0.01".
+
+    Returns:
+    dict: Kind -> probability per request.
+    """
+    errors = {}
+    for item in (spec or "").split(","):
+        if "=" not in item:
+            continue
+        kind, rate = item.split("=", 1)
+        kind = kind.strip()
+        errors[kind if kind == "timeout" else int(kind)] = float(rate)
+    return errors
+
+
+def messages_key(messages) -> str:
+    """Return the key recorded replies are looked up by: a hash of the request's messages"""
+    canonical = json.dumps(messages, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def load_recording(path: str) -> dict:
+    """
+    Load recorded replies.
+
+    Args:
+    path (str): A JSONL file of {"messages": [...], "reply": "..."} lines.
+
+    Returns:
+    dict: messages_key -> reply.
+    """
+    recording = {}
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            if line.strip():
+                entry = json.loads(line)
+                recording[messages_key(entry["messages"])] = entry["reply"]
+    return recording
+
+
+class MockLLM:
+    """
+    The behaviour of the mock server, independent of HTTP.
+
+    Replies come from the recording when the request's messages were
+    recorded, otherwise from the scripted replies in turn (or DEFAULT_REPLY).
+    Every request draws its latency and injected error from a random.Random
+    seeded with the seed and the request's sequence number, so a run with
+    the same seed and request order behaves the same.
+
+    At most slots requests are generated at a time, like the parallel slots
+    of a llama.cpp server; further requests wait for a slot, or are
+    answered with 503 when reject_when_busy is set.
+    """
+
+    def __init__(self, replies=None, recording=None, latency="fixed:0", token_rate=0.0, errors=None,
+                 slots=4, reject_when_busy=False, timeout_seconds=600.0, seed=0, models=("mock",)):
+        """
+        Initialize the MockLLM class.
+
+        Args:
+        replies (list, optional): Scripted replies, served in turn.
+        recording (dict, optional): messages_key -> reply, see load_recording.
+        latency (str): Time to first token distribution, see parse_latency.
+        token_rate (float): Generated tokens per second (0 = instantaneous).
+        errors (dict, optional): Error injection rates, see parse_errors.
+        slots (int): Number of requests generated in parallel.
+        reject_when_busy (bool): Answer 503 instead of queueing when every slot is busy.
+        timeout_seconds (float): How long an injected timeout holds the connection.
+        seed (int): Seed of the per-request random generators.
+        models (tuple): Model ids reported by GET /v1/models.
+        """
+        self.replies = list(replies or [])
+        self.recording = recording or {}
+        self.latency = parse_latency(latency)
+        self.token_rate = token_rate
+        self.errors = errors or {}
+        self.slots = slots
+        self.reject_when_busy = reject_when_busy
+        self.timeout_seconds = timeout_seconds
+        self.seed = seed
+        self.models = list(models)
+        self._slots = threading.BoundedSemaphore(slots)
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._busy = 0
+        self._counts = {}
+
+    def count(self, key) -> None:
+        """Count one request outcome"""
+        with self._lock:
+            self._counts[key] = self._counts.get(key, 0) + 1
+
+    def stats(self) -> dict:
+        """Return request counts per outcome, the busy slots and the peak number of busy slots"""
+        with self._lock:
+            return dict(self._counts, busy=self._busy)
+
+    def plan(self, body: dict) -> dict:
+        """
+        Decide how to answer a chat completion request.
+
+        Args:
+        body (dict): The request body.
+
+        Returns:
+        dict: "error" (a status code, "timeout" or None), "latency" in seconds,
+            "reply" and its "tokens".
+        """
+        sequence = next(self._sequence)
+        rng = random.Random(f"{self.seed}:{sequence}")
+        error = None
+        draw = rng.random()
+        for kind, rate in self.errors.items():
+            if draw < rate:
+                error = kind
+                break
+            draw -= rate
+        reply = self.recording.get(messages_key(body.get("messages", [])))
+        if reply is None:
+            reply = self.replies[sequence % len(self.replies)] if self.replies else DEFAULT_REPLY
+        max_tokens = body.get("max_tokens")
+        tokens = split_tokens(reply)
+        if max_tokens is not None and max_tokens >= 0:
+            tokens = tokens[:max_tokens]
+        return {"error": error, "latency": self.latency(rng), "reply": "".join(tokens), "tokens": tokens}
+
+    def acquire_slot(self) -> bool:
+        """Take a slot, waiting for one unless reject_when_busy is set; return False if rejected"""
+        if not self._slots.acquire(blocking=not self.reject_when_busy):
+            return False
+        with self._lock:
+            self._busy += 1
+            self._counts["peak_busy"] = max(self._counts.get("peak_busy", 0), self._busy)
+        return True
+
+    def release_slot(self) -> None:
+        """Give a slot back"""
+        with self._lock:
+            self._busy -= 1
+        self._slots.release()
+
+    def token_delay(self) -> float:
+        """Return the seconds between two generated tokens"""
+        return 1.0 / self.token_rate if self.token_rate > 0 else 0.0
+
+
+def split_tokens(text: str) -> list:
+    """Split text into pseudo tokens: words with their leading whitespace"""
+    tokens = []
+    current = ""
+    for char in text:
+        if char.isspace() and current and not current.isspace():
+            tokens.append(current)
+            current = ""
+        current += char
+    if current:
+        tokens.append(current)
+    return tokens
+
+
+class MockRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the OpenAI-compatible endpoints of the server's MockLLM"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, body: dict, headers=None) -> None:
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        mock = self.server.mock
+        path = urlparse(self.path).path.rstrip("/")
+        if path.endswith("/models"):
+            self._send_json(200, {"object": "list", "data": [{"id": model, "object": "model"} for model in mock.models]})
+        elif path.endswith("/health"):
+            self._send_json(200, {"status": "ok"})
+        elif path.endswith("/stats"):
+            self._send_json(200, mock.stats())
+        else:
+            self._send_json(404, {"error": {"message": "Not found"}})
+
+    def do_POST(self):
+        mock = self.server.mock
+        path = urlparse(self.path).path.rstrip("/")
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self._send_json(400, {"error": {"message": "Invalid JSON"}})
+            return
+        if "/slots/" in path:
+            # Slot save/restore always succeeds; there is no KV state to keep
+            self._send_json(200, {"id_slot": path.rsplit("/", 1)[-1], "n_saved": 0, "n_restored": 0})
+            return
+        if not path.endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "Not found"}})
+            return
+        plan = mock.plan(body)
+        if plan["error"] == "timeout":
+            mock.count("timeout")
+            time.sleep(mock.timeout_seconds)
+            self.close_connection = True
+            return
+        if plan["error"] is not None:
+            mock.count(plan["error"])
+            self._send_json(plan["error"], {"error": {"message": f"Injected {plan['error']}"}},
+                            headers={"Retry-After": "1"} if plan["error"] == 429 else None)
+            return
+        if not mock.acquire_slot():
+            mock.count(503)
+            self._send_json(503, {"error": {"message": "All slots are busy"}})
+            return
+        try:
+            time.sleep(plan["latency"])
+            if body.get("stream"):
+                self._stream(body, plan)
+            else:
+                time.sleep(mock.token_delay() * len(plan["tokens"]))
+                self._send_json(200, self._completion(body, plan))
+            mock.count(200)
+        except (BrokenPipeError, ConnectionResetError):
+            mock.count("cancelled")
+            self.close_connection = True
+        finally:
+            mock.release_slot()
+
+    def _usage(self, body: dict, plan: dict) -> dict:
+        prompt_tokens = sum(len(split_tokens(str(message.get("content", "")))) + 4
+                            for message in body.get("messages", []))
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(plan["tokens"]),
+            "total_tokens": prompt_tokens + len(plan["tokens"]),
+        }
+
+    def _timings(self, body: dict, plan: dict, predicted: int) -> dict:
+        # llama.cpp-style timings; the mock keeps no prefix cache, so every prompt token is evaluated
+        return {"prompt_n": self._usage(body, plan)["prompt_tokens"], "cache_n": 0, "predicted_n": predicted}
+
+    def _completion(self, body: dict, plan: dict) -> dict:
+        return {
+            "id": "chatcmpl-mock",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model") or self.server.mock.models[0],
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": plan["reply"]},
+                "finish_reason": "stop",
+            }],
+            "usage": self._usage(body, plan),
+        }
+
+    def _stream(self, body: dict, plan: dict) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.close_connection = True
+        model = body.get("model") or self.server.mock.models[0]
+        delay = self.server.mock.token_delay()
+        for index, token in enumerate(plan["tokens"]):
+            if index and delay:
+                time.sleep(delay)
+            chunk = {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion.chunk",
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}],
+            }
+            if body.get("timings_per_token"):
+                chunk["timings"] = self._timings(body, plan, index + 1)
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+        final = {
+            "id": "chatcmpl-mock",
+            "object": "chat.completion.chunk",
+            "model": model,
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+            "usage": self._usage(body, plan),
+            "timings": self._timings(body, plan, len(plan["tokens"])),
+        }
+        self.wfile.write(f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+
+def start_server(mock: MockLLM, host="127.0.0.1", port=8080):
+    """
+    Serve mock in a background thread.
+
+    Args:
+    mock (MockLLM): The behaviour to serve.
+    host (str): The interface to listen on.
+    port (int): The port to listen on (0 picks a free one).
+
+    Returns:
+    ThreadingHTTPServer: The running server; its base URL is
+        f"http://{host}:{server.server_port}/v1". Call shutdown() to stop it.
+    """
+    server = http.server.ThreadingHTTPServer((host, port), MockRequestHandler)
+    server.daemon_threads = True
+    server.mock = mock
+    threading.Thread(target=server.serve_forever, name="llm-mock-server", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a deterministic mock of an OpenAI-compatible chat completions API.')
+    parser.add_argument('--host', default='127.0.0.1', help='Interface to listen on')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on')
+    parser.add_argument('--replies', help='File of scripted replies, separated by lines holding only ---')
+    parser.add_argument('--recording', help='JSONL file of {"messages": [...], "reply": "..."} recorded replies')
+    parser.add_argument('--latency', default='fixed:0', help='Time to first token distribution, e.g. lognormal:-1,0.5')
+    parser.add_argument('--token-rate', type=float, default=0.0, dest="token_rate", help='Tokens per second (0 = instantaneous)')
+    parser.add_argument('--errors', default='', help='Error injection rates, e.g. 429=0.05,502=0.02,timeout=0.01')
+    parser.add_argument('--slots', type=int, default=4, help='Number of requests generated in parallel')
+    parser.add_argument('--reject-when-busy', action='store_true', dest="reject_when_busy", help='Answer 503 instead of queueing when every slot is busy')
+    parser.add_argument('--timeout-seconds', type=float, default=600.0, dest="timeout_seconds", help='How long an injected timeout holds the connection')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    parser.add_argument('--models', default='mock', help='Comma separated model ids to report')
+    args = parser.parse_args()
+
+    replies = None
+    if args.replies:
+        with open(args.replies, encoding="utf-8") as file:
+            replies = [reply.strip() for reply in file.read().split("\n---\n") if reply.strip()]
+    mock = MockLLM(
+        replies=replies,
+        recording=load_recording(args.recording) if args.recording else None,
+        latency=args.latency,
+        token_rate=args.token_rate,
+        errors=parse_errors(args.errors),
+        slots=args.slots,
+        reject_when_busy=args.reject_when_busy,
+        timeout_seconds=args.timeout_seconds,
+        seed=args.seed,
+        models=[model.strip() for model in args.models.split(",") if model.strip()])
+    server = start_server(mock, args.host, args.port)
+    print(f"Mock LLM server listening on http://{args.host}:{server.server_port}/v1")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
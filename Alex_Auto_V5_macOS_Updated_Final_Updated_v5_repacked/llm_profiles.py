@@ -0,0 +1,102 @@
+import json
+import os
+import threading
+from config import Config, model_config
+
+cfg = Config()
+
+# model_config inference params and the request fields llama.cpp-style servers read them from
+REQUEST_PARAMS = {
+    "temp": "temperature",
+    "top_k": "top_k",
+    "top_p": "top_p",
+    "repeat_penalty": "repeat_penalty",
+    "repeat_last_n": "repeat_last_n",
+    "tfs_z": "tfs_z",
+    "typical_p": "typical_p",
+    "frequency_penalty": "frequency_penalty",
+    "presence_penalty": "presence_penalty",
+    "penalize_nl": "penalize_nl",
+    "mirostat": "mirostat",
+    "mirostat_tau": "mirostat_tau",
+    "mirostat_eta": "mirostat_eta",
+}
+
+# Per-task variants layered over the base profile. Besides request fields,
+# a variant may set n_ctx, the context budget chat_with_ai packs the agent turn into.
+DEFAULT_VARIANTS = {
+    "agent_turn": {},
+    "json_fix": {"temperature": 0},
+    "ai_function": {"temperature": 0},
+    "summarize": {"temperature": 0, "top_k": 1, "max_tokens": 300},
+    "summarize_history": {"temperature": 0},
+    "sub_agent": {},
+}
+
+# Profile fields that are handled by the client rather than sent as is
+CLIENT_FIELDS = ("n_ctx",)
+
+_profiles = None
+_profiles_lock = threading.Lock()
+
+
+def load_profiles(inference_params: dict, path=None, temperature=None) -> dict:
+    """
+    Build the base profile and its per-task variants.
+
+    Args:
+    inference_params (dict): model_config["inference_params"], or {} to leave
+        sampling to the server's defaults.
+    path (str, optional): A JSON file of {"base": {...}, "<call_site>": {...}}
+        overrides, merged over the defaults.
+    temperature (float, optional): Overrides the base temperature of inference_params.
+
+    Returns:
+    dict: "base" and one merged profile per call site.
+    """
+    base = {target: inference_params[source] for source, target in REQUEST_PARAMS.items() if source in inference_params}
+    if temperature is not None:
+        base["temperature"] = temperature
+    variants = {name: dict(variant) for name, variant in DEFAULT_VARIANTS.items()}
+    if path:
+        with open(path, encoding="utf-8") as file:
+            overrides = json.load(file)
+        base.update(overrides.pop("base", {}))
+        for name, variant in overrides.items():
+            variants.setdefault(name, {}).update(variant)
+    profiles = {"base": base}
+    for name, variant in variants.items():
+        profiles[name] = dict(base, **variant)
+    return profiles
+
+
+def get_profile(call_site) -> dict:
+    """Return the performance profile for call_site (the base profile if it has no variant)"""
+    global _profiles
+    if _profiles is None:
+        with _profiles_lock:
+            if _profiles is None:
+                inference_params = model_config["inference_params"] if cfg.llm_send_sampling_params else {}
+                # An explicitly set TEMPERATURE wins over model_config's temp
+                temperature = cfg.temperature if os.getenv("TEMPERATURE") is not None else None
+                _profiles = load_profiles(inference_params, cfg.llm_profiles_file or None, temperature)
+    return _profiles.get(call_site or "other", _profiles["base"])
+
+
+def apply_profile(payload: dict, call_site) -> dict:
+    """
+    Fill in the request fields of call_site's profile that the caller left unset.
+
+    A temperature or max_tokens of None takes the profile's value; without one
+    (LLM_SEND_SAMPLING_PARAMS=False and no variant), temperature falls back to
+    the TEMPERATURE setting.
+    """
+    profile = get_profile(call_site)
+    if payload.get("temperature") is None:
+        payload["temperature"] = profile.get("temperature", cfg.temperature)
+    if payload.get("max_tokens") is None:
+        payload["max_tokens"] = profile.get("max_tokens")
+    for key, value in profile.items():
+        if key not in CLIENT_FIELDS:
+            payload.setdefault(key, value)
+    return payload
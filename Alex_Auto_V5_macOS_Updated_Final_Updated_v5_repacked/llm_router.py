@@ -0,0 +1,114 @@
+import collections
+import threading
+import time
+from llm_metrics import metrics
+
+# Call statuses that say nothing about the model's own latency
+IGNORED_STATUSES = ("cache", "coalesced")
+
+
+class ModelRouter:
+    """
+    Picks the model for each call site from a policy table and live statistics.
+
+    The policy lists a call site's models in order of preference. The first
+    model whose recent p95 latency at that call site is within the call site's
+    budget and whose recent error rate is acceptable is used; models without
+    enough recent samples are tried optimistically. If every model is over
+    budget, the one with the lowest p95 is used. Samples older than window
+    seconds are forgotten, so a model that fell back gets another chance.
+    """
+
+    def __init__(self, policy: dict, budgets: dict, default_budget=0.0, max_error_rate=0.5,
+                 window=300.0, min_samples=5, resolve=None, available=None):
+        """
+        Initialize the ModelRouter class.
+
+        Args:
+        policy (dict): Call site -> list of models, most preferred first.
+        budgets (dict): Call site -> p95 latency budget in seconds.
+        default_budget (float): Budget of call sites not in budgets (0 = none).
+        max_error_rate (float): Recent error rate above which a model is skipped.
+        window (float): Seconds of history the statistics are computed over.
+        min_samples (int): Samples needed before a model's statistics are trusted.
+        resolve (callable, optional): Maps policy entries such as "fast" to model ids.
+        available (callable, optional): Returns False for models no endpoint serves.
+        """
+        self.policy = policy
+        self.budgets = budgets
+        self.default_budget = default_budget
+        self.max_error_rate = max_error_rate
+        self.window = window
+        self.min_samples = min_samples
+        self.resolve = resolve or (lambda model: model)
+        self.available = available or (lambda model: True)
+        self._lock = threading.Lock()
+        self._samples = {}
+
+    def route(self, call_site, default=None):
+        """Return the model to use for a call from call_site, or default if the policy has none"""
+        models = [self.resolve(model) for model in self.policy.get(call_site or "other", [])]
+        candidates = [model for model in models if self.available(model)] or models
+        if not candidates:
+            return default
+        budget = self.budgets.get(call_site, self.default_budget)
+        stats = {model: self._stats(call_site, model) for model in candidates}
+        chosen = None
+        for model in candidates:
+            p95, error_rate, samples = stats[model]
+            if samples < self.min_samples or (
+                    error_rate <= self.max_error_rate and (not budget or p95 <= budget)):
+                chosen = model
+                break
+        if chosen is None:
+            chosen = min(candidates, key=lambda model: (stats[model][1] > self.max_error_rate, stats[model][0]))
+        if chosen != candidates[0]:
+            metrics.incr(f"llm_router_fallbacks[call_site={call_site},model={chosen}]")
+        return chosen
+
+    def observe(self, record, wall_time: float) -> None:
+        """Record a finished call; registered as a CallRecord listener"""
+        if record.model is None or record.status in IGNORED_STATUSES:
+            return
+        ok = record.status in (200, "cancelled")
+        with self._lock:
+            samples = self._samples.setdefault(
+                (record.call_site, record.model), collections.deque(maxlen=200))
+            samples.append((time.monotonic(), wall_time, ok))
+
+    def stats(self) -> dict:
+        """Return p95 latency, error rate and sample count per (call site, model)"""
+        with self._lock:
+            keys = list(self._samples)
+        return {f"{call_site}/{model}": dict(zip(("p95", "error_rate", "samples"), self._stats(call_site, model)))
+                for call_site, model in keys}
+
+    def _stats(self, call_site, model):
+        cutoff = time.monotonic() - self.window
+        with self._lock:
+            recent = [sample for sample in self._samples.get((call_site, model), ()) if sample[0] >= cutoff]
+        if not recent:
+            return 0.0, 0.0, 0
+        latencies = sorted(seconds for _, seconds, ok in recent if ok)
+        p95 = latencies[min(len(latencies) - 1, int(round(0.95 * (len(latencies) - 1))))] if latencies else 0.0
+        error_rate = sum(1 for _, _, ok in recent if not ok) / len(recent)
+        return p95, error_rate, len(recent)
+
+
+def parse_policy(spec: str) -> dict:
+    """
+    Parse a routing policy.
+
+    Args:
+    spec (str): Semicolon separated "call_site=model,model" entries, e.g. "json_fix=fast,smart;ai_function=smart,fast".
+
+    Returns:
+    dict: Call site -> list of models.
+    """
+    policy = {}
+    for item in spec.split(";"):
+        if "=" not in item:
+            continue
+        call_site, models = item.split("=", 1)
+        policy[call_site.strip()] = [model.strip() for model in models.split(",") if model.strip()]
+    return policy
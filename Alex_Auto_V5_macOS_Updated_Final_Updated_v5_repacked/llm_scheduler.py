@@ -0,0 +1,122 @@
+import itertools
+import time
+from llm_metrics import metrics
+
+
+class _Ticket:
+    """One caller waiting for a slot"""
+
+    def __init__(self, class_name, priority, finish, sequence):
+        self.class_name = class_name
+        self.priority = priority
+        self.finish = finish
+        self.sequence = sequence
+        self.enqueued_at = time.monotonic()
+
+    def key(self):
+        return self.priority, self.finish, self.sequence
+
+
+class PriorityScheduler:
+    """
+    Orders callers waiting for a slot by priority class, then by weighted fair queuing.
+
+    Waiters of a lower priority number are always served first, so queued
+    interactive calls overtake queued background work. Classes of the same
+    priority share slots in proportion to their weights: every request of a
+    class advances that class's virtual finish time by 1 / weight (given back
+    if it stops waiting before it is admitted), and the waiter with the
+    smallest finish time goes next.
+
+    The scheduler is not thread-safe on its own; the caller (AdaptiveLimiter)
+    holds its lock around every method.
+    """
+
+    def __init__(self, classes: dict, call_sites: dict, default_class=None):
+        """
+        Initialize the PriorityScheduler class.
+
+        Args:
+        classes (dict): Class name -> (priority, weight).
+        call_sites (dict): Call site -> class name.
+        default_class (str, optional): Class of call sites not listed; defaults
+            to the class with the highest priority number.
+        """
+        if not classes:
+            raise ValueError("At least one scheduler class is required")
+        self.classes = classes
+        self.call_sites = call_sites
+        self.default_class = default_class or max(classes, key=lambda name: classes[name][0])
+        self._virtual_time = 0.0
+        self._last_finish = {name: 0.0 for name in classes}
+        self._waiting = []
+        self._sequence = itertools.count()
+
+    def class_for(self, call_site) -> str:
+        """Return the class calls from call_site are queued in"""
+        class_name = self.call_sites.get(call_site or "other", self.default_class)
+        return class_name if class_name in self.classes else self.default_class
+
+    def enqueue(self, call_site) -> _Ticket:
+        """Queue a caller and return its ticket"""
+        class_name = self.class_for(call_site)
+        priority, weight = self.classes[class_name]
+        start = max(self._virtual_time, self._last_finish[class_name])
+        finish = start + 1.0 / weight
+        self._last_finish[class_name] = finish
+        ticket = _Ticket(class_name, priority, finish, next(self._sequence))
+        self._waiting.append(ticket)
+        self._publish(class_name)
+        return ticket
+
+    def is_next(self, ticket: _Ticket) -> bool:
+        """Return True if ticket is the first in line"""
+        return min(self._waiting, key=_Ticket.key) is ticket
+
+    def dequeue(self, ticket: _Ticket, granted=True) -> None:
+        """Remove a ticket once it got a slot (or gave up waiting)"""
+        self._waiting.remove(ticket)
+        cost = 1.0 / self.classes[ticket.class_name][1]
+        if granted:
+            self._virtual_time = max(self._virtual_time, ticket.finish - cost)
+            metrics.incr(f"llm_scheduler_grants[class={ticket.class_name}]")
+            metrics.observe(f"llm_queue_wait_seconds[class={ticket.class_name}]",
+                            time.monotonic() - ticket.enqueued_at)
+        else:
+            # An abandoned request is not charged to its class: the waiters queued behind it move up
+            for other in self._waiting:
+                if other.class_name == ticket.class_name and other.finish > ticket.finish:
+                    other.finish = max(other.finish - cost, self._virtual_time + cost)
+            self._last_finish[ticket.class_name] -= cost
+        self._publish(ticket.class_name)
+
+    def stats(self) -> dict:
+        """Return the number of waiting callers per class"""
+        depths = {name: 0 for name in self.classes}
+        for ticket in self._waiting:
+            depths[ticket.class_name] += 1
+        return depths
+
+    def _publish(self, class_name: str) -> None:
+        depth = sum(1 for ticket in self._waiting if ticket.class_name == class_name)
+        metrics.set_gauge(f"llm_queue_depth[class={class_name}]", depth)
+
+
+def parse_scheduler_classes(spec: str) -> dict:
+    """
+    Parse scheduler classes.
+
+    Args:
+    spec (str): Comma separated "name=priority:weight" entries, e.g. "interactive=0:8,background=1:1".
+
+    Returns:
+    dict: Class name -> (priority, weight).
+    """
+    classes = {}
+    for item in spec.split(","):
+        if "=" not in item:
+            continue
+        name, value = item.split("=", 1)
+        priority, _, weight = value.partition(":")
+        classes[name.strip()] = (int(priority), float(weight or 1))
+    return classes
@@ -0,0 +1,77 @@
+import threading
+from llm_metrics import metrics
+
+
+class _Call:
+    """One in-flight call that followers wait on"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into one execution.
+
+    The first caller for a key (the leader) runs the function; callers that
+    arrive while it is running wait and receive the same result or exception.
+    """
+
+    def __init__(self, name="llm_singleflight"):
+        """Initialize the SingleFlight class"""
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key: str, fn):
+        """
+        Run fn once for all concurrent callers with the same key.
+
+        Args:
+        key (str): Identifies identical requests.
+        fn (callable): Called without arguments by the leader.
+
+        Returns:
+        tuple: fn's result and True if this caller was coalesced into another's call.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.followers += 1
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                leader = True
+
+        if not leader:
+            metrics.incr(f"{self.name}_coalesced")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        metrics.incr(f"{self.name}_leaders")
+        try:
+            call.result = fn()
+            return call.result, False
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self) -> dict:
+        """Return how many calls ran and how many were coalesced into them"""
+        leaders = metrics.get(f"{self.name}_leaders")
+        coalesced = metrics.get(f"{self.name}_coalesced")
+        total = leaders + coalesced
+        return {
+            "leaders": leaders,
+            "coalesced": coalesced,
+            "coalesced_rate": coalesced / total if total else 0.0,
+        }
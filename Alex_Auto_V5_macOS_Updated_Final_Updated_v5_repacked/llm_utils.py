@@ -1,45 +1,1083 @@
 # llm_utils.py
 
+import asyncio
+import functools
+import hashlib
+import itertools
+import json
+import queue
+import socket
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 from config import Config
+from llm_cache import CompletionCache, cache_key
+from json_grammar import schema_to_gbnf
+from llm_endpoints import EndpointPool
+from llm_limiter import AdaptiveLimiter, backoff_delay, parse_retry_after
+from llm_local import get_local_backend
+from llm_metrics import CallRecord, metrics
+from llm_profiles import apply_profile
+from llm_router import ModelRouter, parse_policy
+from llm_scheduler import PriorityScheduler, parse_scheduler_classes
+from llm_singleflight import SingleFlight
 
 cfg = Config()
 
-base_url_sync = "http://192.168.1.101:1234/v1"
+endpoints = EndpointPool(
+    [url.strip() for url in cfg.llm_api_bases.split(",") if url.strip()],
+    eject_after=cfg.llm_eject_after,
+    eject_duration=cfg.llm_eject_duration,
+    model_routing=cfg.llm_model_routing)
 
-def create_chat_completion(messages, model=None, temperature=cfg.temperature, max_tokens=None) -> str:
-    """Create a chat completion using the server (synchronous)"""
-    response = None
-    num_retries = 5
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    """HTTP connection pool that counts checkouts and newly opened connections"""
+
+    def _get_conn(self, timeout=None):
+        metrics.incr("llm_pool_checkouts")
+        return super()._get_conn(timeout)
+
+    def _new_conn(self):
+        metrics.incr("llm_pool_misses")
+        return super()._new_conn()
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    """HTTPS connection pool that counts checkouts and newly opened connections"""
+
+    def _get_conn(self, timeout=None):
+        metrics.incr("llm_pool_checkouts")
+        return super()._get_conn(timeout)
+
+    def _new_conn(self):
+        metrics.incr("llm_pool_misses")
+        return super()._new_conn()
+
+
+class PooledAdapter(HTTPAdapter):
+    """Keep-alive adapter whose pools report hits and misses to llm_metrics"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool,
+        }
+
+
+def parse_host_limits(spec: str) -> dict:
+    """
+    Parse per-host overrides such as pool sizes or concurrency limits.
+
+    Args:
+    spec (str): Comma separated "url=size" pairs, e.g. "http://10.0.0.2:1234=16".
+
+    Returns:
+    dict: A mapping of url prefix to limit.
+    """
+    sizes = {}
+    for item in spec.split(","):
+        if "=" not in item:
+            continue
+        prefix, size = item.rsplit("=", 1)
+        sizes[prefix.strip().rstrip("/") + "/"] = int(size)
+    return sizes
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """Return the process-wide keep-alive session, creating it on first use"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                session.headers.update({"Connection": "keep-alive"})
+                default_adapter = PooledAdapter(
+                    pool_connections=cfg.llm_pool_connections,
+                    pool_maxsize=cfg.llm_pool_maxsize,
+                    max_retries=0)
+                session.mount("http://", default_adapter)
+                session.mount("https://", default_adapter)
+                for prefix, size in parse_host_limits(cfg.llm_pool_sizes).items():
+                    session.mount(prefix, PooledAdapter(
+                        pool_connections=1, pool_maxsize=size, max_retries=0))
+                _session = session
+    return _session
+
+
+def close_session() -> None:
+    """Close the shared session and drop all pooled connections"""
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def get_pool_stats() -> dict:
+    """Return connection pool hit/miss counters for the shared session"""
+    checkouts = metrics.get("llm_pool_checkouts")
+    misses = metrics.get("llm_pool_misses")
+    return {"hits": checkouts - misses, "misses": misses, "checkouts": checkouts}
+
+
+# Status codes that mean the server is overloaded and the call should be retried
+OVERLOAD_STATUS_CODES = (429, 502, 503, 504)
+# Overload responses from a server that is healthy but busy; left to the limiter, they don't count toward ejection
+BUSY_STATUS_CODES = (429, 503)
+# Hedge delays fall back to LLM_HEDGE_DELAY until a call site has this many TTFT samples
+HEDGE_MIN_SAMPLES = 20
+
+limiter = AdaptiveLimiter(
+    initial_limit=cfg.llm_limit_initial,
+    min_limit=cfg.llm_limit_min,
+    max_limit=cfg.llm_limit_max,
+    scheduler=PriorityScheduler(
+        parse_scheduler_classes(cfg.llm_scheduler_classes),
+        dict(item.strip().split("=", 1) for item in cfg.llm_scheduler_call_sites.split(",") if "=" in item))
+    if cfg.llm_scheduler else None)
+
+
+def _probe_endpoint(endpoint):
+    """Health check: GET /models and return the ids of the served models"""
+    response = get_session().get(
+        f"{endpoint.url}/models",
+        timeout=(cfg.llm_connect_timeout, cfg.llm_health_check_timeout))
+    response.raise_for_status()
+    return [model["id"] for model in response.json().get("data", []) if "id" in model]
+
+
+def constrain_payload(payload: dict, schema: dict) -> dict:
+    """
+    Add constrained decoding for schema to a request payload, according to LLM_CONSTRAINED_DECODING.
+
+    "json_schema" sends llama.cpp's json_schema field, "response_format" the
+    OpenAI/LM Studio response_format, and "grammar" a GBNF grammar generated
+    from the schema. "none" leaves the payload unchanged.
+    """
+    mode = cfg.llm_constrained_decoding
+    if schema is None or mode == "none":
+        return payload
+    if mode == "json_schema":
+        payload["json_schema"] = schema
+    elif mode == "response_format":
+        payload["response_format"] = {
+            "type": "json_schema",
+            "json_schema": {"name": "reply", "strict": True, "schema": schema},
+        }
+    elif mode == "grammar":
+        payload["grammar"] = _grammar_for(json.dumps(schema, sort_keys=True))
+    else:
+        raise ValueError(f"Unknown LLM_CONSTRAINED_DECODING mode: {mode}")
+    return payload
+
+
+@functools.lru_cache(maxsize=8)
+def _grammar_for(schema_json: str) -> str:
+    return schema_to_gbnf(json.loads(schema_json))
+
+
+_slot_lock = threading.Lock()
+# slot_key -> (endpoint url, slot id) for requests that reuse a cached prompt prefix
+_slot_assignments = {}
+_next_slot = {}
+_last_completion = threading.local()
+
+
+def _slot_for(slot_key: str, endpoint):
+    """
+    Return the server slot pinned to slot_key on endpoint, assigning one if needed.
+
+    Returns None once every one of the LLM_SERVER_SLOTS slots is pinned to
+    another key: the request is then left to the server's own slot choice,
+    instead of queueing behind and overwriting another key's cached prefix.
+    """
+    with _slot_lock:
+        assigned = _slot_assignments.get(slot_key)
+        if assigned is not None and assigned[0] == endpoint.url:
+            return assigned[1]
+        slot_id = _next_slot.get(endpoint.url, 0)
+        if slot_id >= max(cfg.llm_server_slots, 1):
+            metrics.incr("llm_slot_unpinned")
+            return None
+        _next_slot[endpoint.url] = slot_id + 1
+        _slot_assignments[slot_key] = (endpoint.url, slot_id)
+        return slot_id
+
+
+def _preferred_endpoint(slot_key):
+    """Return the endpoint holding slot_key's cached prefix, if any"""
+    assigned = _slot_assignments.get(slot_key) if slot_key else None
+    if assigned is None:
+        return None
+    try:
+        return endpoints.get(assigned[0])
+    except KeyError:
+        return None
+
+
+def _record_usage(usage, timings, slot_key=None) -> None:
+    """
+    Record prompt tokens evaluated versus reused from the server's prefix cache.
+
+    llama.cpp reports prompt_n (evaluated) and cache_n (reused) in timings;
+    OpenAI-style servers report usage.prompt_tokens_details.cached_tokens.
+    """
+    usage = usage or {}
+    timings = timings or {}
+    prompt_tokens = usage.get("prompt_tokens")
+    evaluated = timings.get("prompt_n")
+    reused = timings.get("cache_n")
+    if reused is None:
+        reused = (usage.get("prompt_tokens_details") or {}).get("cached_tokens")
+    if evaluated is None and prompt_tokens is not None:
+        evaluated = prompt_tokens - (reused or 0)
+    if reused is None and prompt_tokens is not None and evaluated is not None:
+        reused = max(0, prompt_tokens - evaluated)
+    if prompt_tokens is None and evaluated is not None and reused is not None:
+        prompt_tokens = evaluated + reused
+    _last_completion.info = {
+        "usage": usage,
+        "timings": timings,
+        "prompt_tokens": prompt_tokens,
+        "prompt_tokens_evaluated": evaluated,
+        "prompt_tokens_reused": reused,
+    }
+    if evaluated is None:
+        return
+    metrics.incr("llm_prompt_tokens_evaluated", evaluated)
+    metrics.incr("llm_prompt_tokens_reused", reused or 0)
+    if slot_key:
+        metrics.set_gauge(f"llm_prompt_tokens_evaluated[{slot_key}]", evaluated)
+        metrics.set_gauge(f"llm_prompt_tokens_reused[{slot_key}]", reused or 0)
+
+
+def get_last_completion_info() -> dict:
+    """Return usage and prefix-cache figures for this thread's last completion (empty if it wasn't sent to a server)"""
+    return getattr(_last_completion, "info", {})
+
+
+_pending_slot_saves = {}
+
+
+def _slot_url(endpoint, slot_id: int, action: str) -> str:
+    # The slot API lives at the server root, not under the OpenAI-compatible /v1 prefix
+    root = endpoint.url[:-len("/v1")] if endpoint.url.endswith("/v1") else endpoint.url
+    return f"{root}/slots/{slot_id}?action={action}"
+
+
+def slot_snapshot_name(prompt: str, model=None) -> str:
+    """Return the file name a slot's KV state for prompt (and model) is saved under"""
+    digest = hashlib.sha256(f"{model}\n{prompt}".encode("utf-8")).hexdigest()
+    return f"autogpt-{digest[:16]}.bin"
+
+
+def restore_slot(slot_key: str, prompt: str, model=None) -> bool:
+    """
+    Restore the KV state saved for prompt into slot_key's server slot.
+
+    Uses the slot save/restore API of llama.cpp-compatible servers (started
+    with --slot-save-path). If nothing was saved for prompt yet, the state is
+    saved after slot_key's next successful call instead, so the following
+    session can skip the prefill of the prompt.
+
+    Args:
+    slot_key (str): The slot_key the prompt is sent with, e.g. "agent".
+    prompt (str): The constant prompt prefix, e.g. the agent's system prompt.
+    model (str, optional): The model the prompt is sent to.
+
+    Returns:
+    bool: True if a saved state was restored.
+    """
+    if not cfg.llm_cache_prompt or cfg.llm_backend != "http":
+        return False
+    filename = slot_snapshot_name(prompt, model)
+    endpoint = _preferred_endpoint(slot_key) or endpoints.acquire(model)
+    endpoints.release(endpoint)
+    slot_id = _slot_for(slot_key, endpoint)
+    if slot_id is None:
+        return False
+    try:
+        response = get_session().post(
+            _slot_url(endpoint, slot_id, "restore"), json={"filename": filename},
+            timeout=(cfg.llm_connect_timeout, cfg.llm_read_timeout))
+    except requests.exceptions.RequestException:
+        response = None
+    if response is not None and response.status_code == 200:
+        metrics.incr("llm_slot_restores")
+        metrics.incr("llm_slot_restored_tokens", response.json().get("n_restored", 0))
+        return True
+    # Nothing saved yet (or the server can't restore it): save after the next call
+    _pending_slot_saves[slot_key] = filename
+    return False
+
+
+def _save_pending_slot(slot_key) -> None:
+    """Save slot_key's KV state if restore_slot asked for it"""
+    filename = _pending_slot_saves.pop(slot_key, None) if slot_key else None
+    endpoint = _preferred_endpoint(slot_key)
+    if filename is None or endpoint is None:
+        return
+    slot_id = _slot_for(slot_key, endpoint)
+    if slot_id is None:
+        return
+    try:
+        response = get_session().post(
+            _slot_url(endpoint, slot_id, "save"), json={"filename": filename},
+            timeout=(cfg.llm_connect_timeout, cfg.llm_read_timeout))
+    except requests.exceptions.RequestException:
+        return
+    if response.status_code == 200:
+        metrics.incr("llm_slot_saves")
+
+
+def parse_call_site_values(spec: str) -> dict:
+    """
+    Parse per-call-site settings.
+
+    Args:
+    spec (str): Comma separated "call_site=value" pairs, e.g. "agent_turn=120,json_fix=30".
+
+    Returns:
+    dict: A mapping of call site to float value.
+    """
+    values = {}
+    for item in spec.split(","):
+        if "=" not in item:
+            continue
+        call_site, value = item.split("=", 1)
+        values[call_site.strip()] = float(value)
+    return values
+
+
+def _deadline_for(call_site, started_at: float):
+    """Return the time.monotonic() deadline for a call, or None if it has none"""
+    seconds = parse_call_site_values(cfg.llm_deadlines).get(call_site or "other", cfg.llm_deadline)
+    return started_at + seconds if seconds else None
+
+
+def _remaining(deadline):
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def _post_with_retries(payload, stream=False, endpoint=None, slot_key=None, record=None, deadline=None,
+                       exclude=(), cancelled=None):
+    """
+    POST a chat completion payload through the adaptive limiter.
+
+    Each attempt is routed to the least loaded healthy endpoint serving the
+    model; endpoint, if given, was already acquired from the pool and is used
+    for the first attempt. Overload responses (429/502/503/504), timeouts and
+    connection errors are retried with exponential backoff and jitter,
+    honoring Retry-After. For streamed requests the limiter slot and the
+    endpoint stay held after a 200 and must be released once the stream is
+    finished. Requests sharing a slot_key stick to one endpoint and server
+    slot so the server can reuse their cached prompt prefix. Retries, status
+    codes and the chosen endpoint are noted on record, if given. deadline is
+    a time.monotonic() value after which no further attempt is made, and
+    exclude lists endpoints to avoid. cancelled, if given, is a
+    threading.Event set once a hedge has answered in this call's place; the
+    call then stops, and its failures are recorded as cancelled and not held
+    against the endpoint.
+
+    Returns:
+    tuple: The 200 response and the Endpoint that served it.
+    """
+    num_retries = cfg.llm_max_retries
+    record = record or CallRecord(None)
+    session = get_session()
+    endpoints.start_health_checks(_probe_endpoint, cfg.llm_health_check_interval)
     for attempt in range(num_retries):
+        retry_after = None
+        remaining = _remaining(deadline)
+        if remaining is not None and remaining <= 0:
+            if endpoint is not None:
+                endpoints.release(endpoint)
+            record.status = "deadline"
+            raise TimeoutError(f"LLM call to {record.call_site} exceeded its deadline")
+        if cancelled is not None and cancelled.is_set():
+            if endpoint is not None:
+                endpoints.release(endpoint)
+            record.status = "cancelled"
+            raise RuntimeError(f"LLM call to {record.call_site} was superseded by a hedge")
+        if endpoint is None:
+            endpoint = endpoints.acquire(
+                payload.get("model"), preferred=_preferred_endpoint(slot_key), exclude=exclude)
+        record.endpoint = endpoint
+        body = payload
+        if cfg.llm_cache_prompt:
+            body = dict(body, cache_prompt=True)
+            if stream:
+                # Every chunk then carries prompt_n and cache_n, so the prompt token counts are known
+                # even when the stream is cut before the final usage chunk (LLM_STOP_AT_JSON_END, LLM_N_BEST)
+                body["timings_per_token"] = True
+            slot_id = _slot_for(slot_key, endpoint) if slot_key else None
+            if slot_id is not None:
+                body["id_slot"] = slot_id
+        if not limiter.acquire(timeout=remaining, call_site=record.call_site):
+            # Waiting for a slot used up the deadline
+            endpoints.release(endpoint)
+            record.status = "deadline"
+            raise TimeoutError(f"LLM call to {record.call_site} exceeded its deadline")
+        remaining = _remaining(deadline)
+        timeout = (cfg.llm_connect_timeout,
+                   cfg.llm_read_timeout if remaining is None else max(0.001, min(cfg.llm_read_timeout, remaining)))
         try:
-            url = f"{base_url_sync}/chat/completions"
-            payload = {
-                "model": model,
-                "messages": messages,
-                "temperature": temperature,
-                "max_tokens": max_tokens
-            }
-            response = requests.post(url, json=payload)
+            response = session.post(
+                f"{endpoint.url}/chat/completions", json=body, timeout=timeout, stream=stream)
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            if isinstance(e, requests.exceptions.ReadTimeout) and timeout[1] < cfg.llm_read_timeout:
+                # The read timeout was cut short by the deadline, which says nothing about the server
+                limiter.release(success=False)
+                endpoints.release(endpoint)
+                record.status = "deadline"
+                raise TimeoutError(f"LLM call to {record.call_site} exceeded its deadline") from e
+            superseded = cancelled is not None and cancelled.is_set()
+            limiter.release(overloaded=True)
+            endpoints.release(endpoint, failed=not superseded)
+            if superseded:
+                record.status = "cancelled"
+                raise
+            record.status = "timeout" if isinstance(e, requests.exceptions.Timeout) else "connection_error"
+            if attempt == num_retries - 1:
+                raise
+            metrics.incr("llm_retries")
+            record.retries += 1
+        except Exception:
+            limiter.release(success=False)
+            endpoints.release(endpoint)
+            record.status = "error"
+            raise
+        else:
+            record.status = response.status_code
             if response.status_code == 200:
+                if not stream:
+                    limiter.release()
+                    endpoints.release(endpoint)
+                return response, endpoint
+            response.close()
+            superseded = cancelled is not None and cancelled.is_set()
+            if superseded:
+                record.status = "cancelled"
+            if response.status_code not in OVERLOAD_STATUS_CODES:
+                limiter.release(success=False)
+                endpoints.release(endpoint, failed=response.status_code >= 500 and not superseded)
+                raise RuntimeError(f"Received unexpected status code: {response.status_code}")
+            # Rate limit reached or bad gateway: the server is overloaded
+            limiter.release(overloaded=True)
+            endpoints.release(endpoint, failed=response.status_code not in BUSY_STATUS_CODES and not superseded)
+            if superseded:
+                raise RuntimeError(f"LLM call to {record.call_site} was superseded by a hedge")
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            if attempt == num_retries - 1:
                 break
-            elif response.status_code == 429:
-                # Handle rate limit reached
-                pass
-            elif response.status_code == 502:
-                # Handle bad gateway
+            metrics.incr("llm_retries")
+            record.retries += 1
+        endpoint = None
+        delay = backoff_delay(attempt, cfg.llm_backoff_base, cfg.llm_backoff_max, retry_after)
+        remaining = _remaining(deadline)
+        time.sleep(delay if remaining is None else max(0.0, min(delay, remaining)))
+
+    raise RuntimeError(f"Failed to get response after {num_retries} retries")
+
+
+def _resolve_model(model: str) -> str:
+    return {"fast": cfg.fast_llm_model, "smart": cfg.smart_llm_model}.get(model, model)
+
+
+router = None
+if cfg.llm_router:
+    router = ModelRouter(
+        parse_policy(cfg.llm_router_policy),
+        parse_call_site_values(cfg.llm_router_budgets),
+        default_budget=cfg.llm_router_budget,
+        max_error_rate=cfg.llm_router_max_error_rate,
+        window=cfg.llm_router_window,
+        resolve=_resolve_model,
+        available=lambda model: any(endpoint.serves(model) for endpoint in endpoints.endpoints))
+    CallRecord.listeners.append(router.observe)
+
+
+def route_model(call_site, default=None):
+    """Return the model the router picks for call_site, or default if LLM_ROUTER is off"""
+    if router is None:
+        return default
+    return router.route(call_site, default)
+
+
+singleflight = SingleFlight()
+
+_completion_cache = None
+_completion_cache_lock = threading.Lock()
+
+
+def get_completion_cache():
+    """Return the persistent completion cache, or None if LLM_CACHE is disabled"""
+    global _completion_cache
+    if not cfg.llm_cache:
+        return None
+    if _completion_cache is None:
+        with _completion_cache_lock:
+            if _completion_cache is None:
+                _completion_cache = CompletionCache(
+                    cfg.llm_cache_path,
+                    max_entries=cfg.llm_cache_max_entries,
+                    max_bytes=cfg.llm_cache_max_bytes,
+                    ttl=cfg.llm_cache_ttl)
+    return _completion_cache
+
+
+def create_chat_completion(messages, model=None, temperature=None, max_tokens=None, cache=None,
+                           slot_key=None, stop=None, response_schema=None, call_site=None) -> str:
+    """
+    Create a chat completion using the server (synchronous)
+
+    Args:
+    temperature (float, optional), max_tokens (int, optional): Default to the
+        call site's performance profile (see llm_profiles), and temperature
+        then to TEMPERATURE.
+    cache (bool, optional): Use the persistent completion cache. By default only
+        deterministic (temperature 0) calls are cached; True opts a call in and
+        False opts it out. Has no effect unless LLM_CACHE is enabled.
+    slot_key (str, optional): Pin calls with the same key to one endpoint and
+        server slot so a constant prompt prefix is prefilled only once.
+        Requires LLM_CACHE_PROMPT.
+    stop (list, optional): Stop sequences.
+    response_schema (dict, optional): JSON schema the reply must follow, enforced
+        by the server according to LLM_CONSTRAINED_DECODING.
+    call_site (str, optional): Label for latency metrics and the performance
+        profile to use, e.g. "agent_turn", "json_fix", "summarize" or "sub_agent".
+    """
+    return _create_chat_completion(messages, model, temperature, max_tokens, cache, slot_key=slot_key, stop=stop,
+                                   response_schema=response_schema, call_site=call_site)
+
+
+def _create_chat_completion(messages, model, temperature, max_tokens, cache, endpoint=None, slot_key=None,
+                            stop=None, response_schema=None, call_site=None) -> str:
+    if model is None:
+        model = route_model(call_site)
+    record = CallRecord(call_site, model)
+    _last_completion.info = {}
+    payload = {
+        "model": model,
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens
+    }
+    if stop:
+        payload["stop"] = stop
+    constrain_payload(payload, response_schema)
+    apply_profile(payload, call_site)
+    if cache is None:
+        cache = payload["temperature"] == 0
+    completion_cache = get_completion_cache() if cache else None
+    if completion_cache is not None:
+        key = cache_key(payload)
+        content = completion_cache.get(key)
+        if content is not None:
+            if endpoint is not None:
+                endpoints.release(endpoint)
+            record.finish(status="cache")
+            return content
+
+    deadline = _deadline_for(call_site, record.started_at)
+
+    def fetch():
+        if _should_hedge(record.call_site):
+            # Hedging races the first token, so the request is streamed internally
+            stream_payload = dict(payload, stream=True, stream_options={"include_usage": True})
+            content = _open_hedged_stream(stream_payload, slot_key, record, deadline, endpoint).consume()
+            if completion_cache is not None and content:
+                completion_cache.put(key, content)
+            return content
+
+        if cfg.llm_backend == "local":
+            if endpoint is not None:
+                endpoints.release(endpoint)
+            body = _local_completion(payload, record)
+        else:
+            try:
+                response, _ = _post_with_retries(
+                    payload, endpoint=endpoint, slot_key=slot_key, record=record, deadline=deadline)
+            finally:
+                if record.status != 200:
+                    record.finish()
+            body = response.json()
+        _record_usage(body.get("usage"), body.get("timings"), slot_key)
+        record.finish(body.get("usage"))
+        _save_pending_slot(slot_key)
+        content = body.get("choices", [])[0].get("message", {}).get("content", "")
+        if completion_cache is not None and content:
+            completion_cache.put(key, content)
+        return content
+
+    if not cfg.llm_singleflight:
+        return fetch()
+
+    # Identical requests already in flight share one upstream call
+    content, coalesced = singleflight.do(cache_key(payload), fetch)
+    if coalesced:
+        if endpoint is not None:
+            endpoints.release(endpoint)
+        record.finish(status="coalesced")
+    return content
+
+
+class ChatCompletionStream:
+    """
+    Iterator over the content deltas of a streamed (SSE) chat completion.
+
+    Once the stream is exhausted, text, usage, finish_reason and
+    time_to_first_token hold the final results.
+    """
+
+    def __init__(self, response, started_at: float, on_close=None, record=None, deadline=None, chunks=None,
+                 cancelled=None):
+        """
+        Wrap a streaming requests response that has already returned 200, or
+        an iterator of already decoded chunks (with response None).
+
+        on_close, if given, is called once with overloaded=True/False when the
+        stream is closed. record, if given, is told when the first token arrives.
+        deadline, if given, is the time.monotonic() value after which reading
+        stops with a TimeoutError. cancelled, if given, is a threading.Event the
+        chunks generator checks between chunks; closing the stream sets it.
+        """
+        self.response = response
+        self.chunks = chunks
+        self.cancelled = cancelled
+        self.started_at = started_at
+        self.record = record
+        self.on_close = on_close
+        self.deadline = deadline
+        self.endpoint = None
+        self._failed = False
+        self._cancelling = False
+        self._closed = False
+        self._close_lock = threading.Lock()
+        self.usage = None
+        self.timings = None
+        self.finish_reason = None
+        self.time_to_first_token = None
+        self.done = False
+        self._parts = []
+        self._consumed = False
+        self._deltas = None
+        self._primed = []
+
+    @property
+    def text(self) -> str:
+        """The content received so far"""
+        return "".join(self._parts)
+
+    def __iter__(self):
+        if self._consumed:
+            raise RuntimeError("A ChatCompletionStream can only be iterated once")
+        self._consumed = True
+        yield from self._primed
+        yield from self._iter_deltas()
+
+    def prime(self) -> None:
+        """Block until the first delta (or the end of the stream) has arrived, without consuming it"""
+        if not self._primed and not self.done:
+            self._primed.extend(itertools.islice(self._iter_deltas(), 1))
+
+    def cancel(self) -> None:
+        """Abandon the request; a reader blocked on it sees the connection close"""
+        if self._closed:
+            # The connection may already be back in the pool, serving another request
+            return
+        if self.finish_reason is None:
+            self.finish_reason = "cancelled"
+        # The reader sees the socket shut down before close() runs; it must not take that for a failed server
+        self._cancelling = True
+        # Closing the response waits for a reader blocked on it, so shut the socket down first
+        connection = getattr(getattr(self.response, "raw", None), "_connection", None)
+        sock = getattr(connection, "sock", None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
                 pass
-            else:
-                raise RuntimeError(f"Received unexpected status code: {response.status_code}")
+        self.close()
+
+    def _iter_deltas(self):
+        # One generator is shared by prime() and __iter__, so primed deltas are not re-read
+        if self._deltas is None:
+            self._deltas = self._read_deltas()
+        return self._deltas
+
+    def _read_chunks(self):
+        if self.chunks is not None:
+            yield from self.chunks
+            return
+        # SSE is always UTF-8, but servers rarely say so in the Content-Type
+        self.response.encoding = "utf-8"
+        for line in self.response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            yield json.loads(data)
+
+    def _read_deltas(self):
+        try:
+            for chunk in self._read_chunks():
+                if self.deadline is not None and time.monotonic() >= self.deadline:
+                    raise TimeoutError("LLM stream exceeded its deadline")
+                if chunk.get("usage"):
+                    self.usage = chunk["usage"]
+                if chunk.get("timings"):
+                    self.timings = chunk["timings"]
+                for choice in chunk.get("choices", []):
+                    if choice.get("finish_reason"):
+                        self.finish_reason = choice["finish_reason"]
+                    delta = (choice.get("delta") or {}).get("content")
+                    if delta:
+                        if self.time_to_first_token is None:
+                            self.time_to_first_token = time.monotonic() - self.started_at
+                            if self.record is not None:
+                                self.record.first_token()
+                        self._parts.append(delta)
+                        yield delta
+            self.done = True
         except Exception as e:
-            if attempt == num_retries - 1:
-                raise
-            else:
-                # Handle other exceptions
+            if self._closed or self._cancelling:
+                # cancel() closed the connection under a blocked reader
+                return
+            if self.deadline is not None and time.monotonic() >= self.deadline:
+                if self.record is not None:
+                    self.record.status = "deadline"
+                if not isinstance(e, TimeoutError):
+                    raise TimeoutError("LLM stream exceeded its deadline") from e
+            if isinstance(e, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)):
+                self._failed = True
+            raise
+        finally:
+            self.close()
+
+    def consume(self, on_token=None, until=None) -> str:
+        """
+        Read the stream and return the final text.
+
+        Args:
+        on_token (callable, optional): Called with every delta as it arrives.
+        until (callable, optional): Called with every delta; once it returns an
+            offset into the text, the reply is cut there and the request is
+            cancelled so the server stops generating.
+
+        Returns:
+        str: The complete (or cut) reply.
+        """
+        for delta in self:
+            if on_token is not None:
+                on_token(delta)
+            if until is not None:
+                end = until(delta)
+                if end is not None:
+                    self._parts = [self.text[:end]]
+                    self.finish_reason = "cancelled"
+                    metrics.incr("llm_stream_early_stops")
+                    self.close()
+                    break
+        return self.text
+
+    def close(self) -> None:
+        """Stop reading and release the underlying connection"""
+        with self._close_lock:
+            # cancel() and a reader woken by it may both get here
+            if self._closed:
+                return
+            self._closed = True
+        if self.response is not None:
+            self.response.close()
+        elif self.chunks is not None:
+            # Stop the in-process model. A generator can only be closed while suspended; if another
+            # thread is running it (e.g. an n-best candidate waiting for the model lock), the flag
+            # stops it at its next chunk instead.
+            if self.cancelled is not None:
+                self.cancelled.set()
+            try:
+                self.chunks.close()
+            except (AttributeError, ValueError):
                 pass
+        if self.on_close is not None:
+            self.on_close(overloaded=self._failed)
 
-    if response is None:
-        raise RuntimeError("Failed to get response after 5 retries")
 
-    content = response.json().get("choices", [])[0].get("message", {}).get("content", "")
-    return content
+def stream_chat_completion(messages, model=None, temperature=None, max_tokens=None,
+                           slot_key=None, stop=None, response_schema=None, call_site=None) -> ChatCompletionStream:
+    """
+    Create a streamed chat completion using the server.
+
+    Retries only apply until the server starts answering; the returned
+    ChatCompletionStream yields content deltas as they arrive. slot_key, stop,
+    response_schema and call_site work as in create_chat_completion.
+    """
+    if model is None:
+        model = route_model(call_site)
+    payload = {
+        "model": model,
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "stream": True,
+        "stream_options": {"include_usage": True},
+    }
+    if stop:
+        payload["stop"] = stop
+    constrain_payload(payload, response_schema)
+    apply_profile(payload, call_site)
+    record = CallRecord(call_site, model)
+    _last_completion.info = {}
+    deadline = _deadline_for(call_site, record.started_at)
+    if cfg.llm_backend == "local":
+        return _open_local_stream(payload, slot_key, record, deadline)
+    if _should_hedge(record.call_site):
+        return _open_hedged_stream(payload, slot_key, record, deadline)
+    return _open_stream(payload, slot_key, record, deadline)
+
+
+def _local_completion(payload, record) -> dict:
+    """Answer payload with the in-process model instead of a server"""
+    try:
+        body = get_local_backend().create_chat_completion(payload)
+    except Exception:
+        record.finish(status="error")
+        raise
+    record.status = 200
+    return body
+
+
+def _open_local_stream(payload, slot_key, record, deadline) -> ChatCompletionStream:
+    """Stream payload from the in-process model; closing the stream finishes record"""
+    cancelled = threading.Event()
+    chunks = get_local_backend().stream_chat_completion(payload, cancelled)
+    record.status = 200
+
+    def on_close(overloaded):
+        if stream.usage or stream.timings:
+            _record_usage(stream.usage, stream.timings, slot_key)
+        if overloaded:
+            record.status = "stream_error"
+        elif stream.finish_reason == "cancelled" and record.status != "deadline":
+            record.status = "cancelled"
+        record.finish(stream.usage)
+
+    stream = ChatCompletionStream(
+        None, record.started_at, on_close=on_close, record=record, deadline=deadline, chunks=chunks,
+        cancelled=cancelled)
+    return stream
+
+
+def _open_stream(payload, slot_key, record, deadline, endpoint=None, exclude=(),
+                 cancelled=None) -> ChatCompletionStream:
+    """POST a streamed payload and wrap the response; closing the stream finishes record"""
+    try:
+        response, endpoint = _post_with_retries(
+            payload, stream=True, endpoint=endpoint, slot_key=slot_key, record=record, deadline=deadline,
+            exclude=exclude, cancelled=cancelled)
+    finally:
+        if record.status != 200:
+            record.finish()
+
+    def on_close(overloaded):
+        limiter.release(overloaded=overloaded)
+        endpoints.release(endpoint, failed=overloaded)
+        if stream.usage or stream.timings:
+            _record_usage(stream.usage, stream.timings, slot_key)
+        if overloaded:
+            record.status = "stream_error"
+        elif stream.finish_reason == "cancelled" and record.status != "deadline":
+            record.status = "cancelled"
+        record.finish(stream.usage)
+        if record.status in (200, "cancelled"):
+            _save_pending_slot(slot_key)
+
+    stream = ChatCompletionStream(response, record.started_at, on_close=on_close, record=record, deadline=deadline)
+    stream.endpoint = endpoint
+    return stream
+
+
+def _should_hedge(call_site: str) -> bool:
+    """Return True if calls from call_site may be hedged"""
+    if not cfg.llm_hedge or cfg.llm_backend != "http" or len(endpoints.endpoints) < 2:
+        return False
+    call_sites = [site.strip() for site in cfg.llm_hedge_call_sites.split(",") if site.strip()]
+    return not call_sites or call_site in call_sites
+
+
+def _hedge_delay(call_site: str) -> float:
+    """Return how long to wait for a first token before hedging a call from call_site"""
+    delay = metrics.percentile(
+        f"llm_time_to_first_token_seconds[call_site={call_site}]", cfg.llm_hedge_percentile,
+        min_samples=HEDGE_MIN_SAMPLES)
+    return cfg.llm_hedge_delay if delay is None else delay
+
+
+def _open_hedged_stream(payload, slot_key, record, deadline, endpoint=None) -> ChatCompletionStream:
+    """
+    Open a stream and, if no token has arrived after the call site's usual
+    time to first token, send the same request to another endpoint.
+
+    Whichever attempt produces a token first is returned; the other is
+    cancelled, and recorded as such rather than as a failure of its
+    endpoint. The hedge is recorded under "<call_site>_hedge". If it wins,
+    the call site's record is finished with its outcome once it closes,
+    timed from the primary's start.
+    """
+    results = queue.Queue()
+    lock = threading.Lock()
+    opened = []
+    chosen = []
+    # attempt record -> Event set when the attempt loses
+    superseded = {}
+
+    def attempt(attempt_record, attempt_endpoint, exclude, attempt_slot_key):
+        try:
+            stream = _open_stream(
+                payload, attempt_slot_key, attempt_record, deadline, attempt_endpoint, exclude,
+                superseded[attempt_record])
+        except Exception as e:
+            results.put((None, e))
+            return
+        with lock:
+            opened.append(stream)
+            lost = bool(chosen)
+        if lost:
+            stream.cancel()
+            return
+        try:
+            stream.prime()
+        except Exception as e:
+            results.put((None, e))
+            return
+        results.put((stream, None))
+
+    def start(attempt_record, *args):
+        superseded[attempt_record] = threading.Event()
+        threading.Thread(
+            target=attempt, args=(attempt_record,) + args, name="llm-hedge", daemon=True).start()
+
+    start(record, endpoint, (), slot_key)
+    pending = 1
+    hedged = False
+    first_error = None
+    while True:
+        try:
+            stream, error = results.get(timeout=None if hedged else _hedge_delay(record.call_site))
+        except queue.Empty:
+            # The primary is slower than usual: race a copy on another endpoint
+            hedged = True
+            pending += 1
+            metrics.incr(f"llm_hedges[call_site={record.call_site}]")
+            exclude = (record.endpoint,) if record.endpoint is not None else ()
+            start(CallRecord(f"{record.call_site}_hedge", record.model), None, exclude, None)
+            continue
+        pending -= 1
+        if stream is not None:
+            break
+        first_error = first_error or error
+        if pending == 0:
+            raise first_error
+
+    with lock:
+        if stream.record is not record:
+            # The cancelled primary must not report the moment it was cancelled as the call's latency
+            record.superseded = True
+        chosen.append(stream)
+        losers = [other for other in opened if other is not stream]
+        # An attempt still connecting or retrying stops, and its failures don't count against its endpoint
+        for attempt_record, event in superseded.items():
+            if attempt_record is not stream.record:
+                event.set()
+    for loser in losers:
+        loser.cancel()
+    if stream.record is not record:
+        metrics.incr(f"llm_hedge_wins[call_site={record.call_site}]")
+        hedge_on_close = stream.on_close
+
+        def on_close(overloaded):
+            hedge_on_close(overloaded)
+            # The call site's figures get the winner's status and the caller's full wait
+            record.finish_as(stream.record, stream.usage)
+
+        stream.on_close = on_close
+    return stream
+
+
+_executor = None
+_executor_lock = threading.Lock()
+# asyncio semaphores belong to one event loop, so keep a set per loop
+_loop_semaphores = weakref.WeakKeyDictionary()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    """Return the worker pool that runs blocking requests for the async client"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=cfg.llm_async_max_concurrency,
+                    thread_name_prefix="llm")
+    return _executor
+
+
+def _get_semaphores(endpoint: str):
+    """Return the (global, per-endpoint) semaphores for the running event loop"""
+    loop = asyncio.get_running_loop()
+    semaphores = _loop_semaphores.get(loop)
+    if semaphores is None:
+        semaphores = {None: asyncio.Semaphore(cfg.llm_async_max_concurrency)}
+        _loop_semaphores[loop] = semaphores
+    if endpoint is not None and endpoint not in semaphores:
+        limits = parse_host_limits(cfg.llm_endpoint_concurrency)
+        limit = next(
+            (value for prefix, value in limits.items() if (endpoint + "/").startswith(prefix)),
+            cfg.llm_endpoint_max_concurrency)
+        semaphores[endpoint] = asyncio.Semaphore(limit)
+    return semaphores[None], semaphores.get(endpoint)
+
+
+async def acreate_chat_completion(messages, model=None, temperature=None, max_tokens=None, cache=None,
+                                  call_site=None) -> str:
+    """
+    Create a chat completion without blocking the event loop.
+
+    Calls are bounded by a global semaphore (LLM_ASYNC_MAX_CONCURRENCY) and a
+    per-endpoint one (LLM_ENDPOINT_MAX_CONCURRENCY / LLM_ENDPOINT_CONCURRENCY),
+    and share the pooled session with create_chat_completion.
+    """
+    if model is None:
+        model = route_model(call_site)
+    async with _get_semaphores(None)[0]:
+        # Count the call against its endpoint while it waits for a slot there,
+        # so concurrent callers spread across endpoints
+        endpoint = endpoints.acquire(model)
+        try:
+            endpoint_limit = _get_semaphores(endpoint.url)[1]
+            await endpoint_limit.acquire()
+        except BaseException:
+            endpoints.release(endpoint)
+            raise
+        metrics.incr("llm_async_inflight")
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                _get_executor(),
+                functools.partial(_create_chat_completion, messages, model, temperature, max_tokens, cache, endpoint,
+                                  call_site=call_site))
+        finally:
+            metrics.incr("llm_async_inflight", -1)
+            endpoint_limit.release()
@@ -1,9 +1,12 @@
+import atexit
 import json
 import random
 import commands as cmd
 import utils
 from memory import get_memory, get_supported_memory_backends
 import chat
+import llm_metrics
+import llm_utils
 from colorama import Fore, Style
 from spinner import Spinner
 import time
@@ -15,6 +18,7 @@ import traceback
 import yaml
 import argparse
 from logger import logger
+from message_history import MessageHistory
 import logging
 from prompt import get_prompt
 
@@ -299,11 +303,17 @@ def main():
 #    check_openai_api_key()
     parse_arguments()
     logger.set_level(logging.DEBUG if cfg.debug_mode else logging.INFO)
+    if cfg.llm_metrics_port:
+        llm_metrics.start_metrics_server(cfg.llm_metrics_port)
+    if cfg.llm_metrics_dump:
+        atexit.register(llm_metrics.dump_metrics, cfg.llm_metrics_dump)
     ai_name = ""
     prompt = construct_prompt()
+    if cfg.llm_slot_save and llm_utils.restore_slot("agent", prompt, model=cfg.fast_llm_model):
+        logger.typewriter_log("Restored cached system prompt", Fore.GREEN, "")
     # print(prompt)
     # Initialize variables
-    full_message_history = []
+    full_message_history = MessageHistory()
     result = None
     next_action_count = 0
     # Make a constant:
@@ -360,13 +370,21 @@ class Agent:
                 break
 
             # Send message to AI, get response
-            with Spinner("Thinking... "):
+            with Spinner("Thinking... ") as spinner:
+                received = []
+
+                def on_token(delta):
+                    # Show streaming progress instead of an opaque spinner
+                    received.append(delta)
+                    spinner.update_message(f"Receiving reply... {len(received)} tokens ")
+
                 assistant_reply = chat.chat_with_ai(
                     self.prompt,
                     self.user_input,
                     self.full_message_history,
                     self.memory,
-                    cfg.fast_token_limit)  # TODO: This hardcodes the model to use GPT3.5. Make this an argument
+                    cfg.fast_token_limit,
+                    on_token=on_token)  # TODO: This hardcodes the model to use GPT3.5. Make this an argument
 
             # Print Assistant thoughts
             print_assistant_thoughts(assistant_reply)
@@ -55,7 +55,7 @@ class PineconeMemory(MemoryProviderSingleton):
         """
         query_embedding = get_ada_embedding(data)
         results = self.index.query(query_embedding, top_k=num_relevant, include_metadata=True)
-        sorted_results = sorted(results.matches, key=lambda x: x.score)
+        sorted_results = sorted(results.matches, key=lambda x: x.score, reverse=True)
         return [str(item['metadata']["raw_text"]) for item in sorted_results]
 
     def get_stats(self):
@@ -0,0 +1,128 @@
+import bisect
+import token_counter
+
+
+class MessageHistory(list):
+    """
+    A message list that remembers the token count of every message.
+
+    Each message is tokenized once per model, when it is appended (or the
+    first time a window is asked for that model), and the counts are kept
+    as prefix sums. window() then finds the longest run of recent messages
+    that fits a budget with a binary search instead of re-tokenizing the
+    history every turn.
+
+    It is a list, so existing code that appends to or slices the history
+    keeps working. Mutations other than append and extend drop the counts;
+    they are rebuilt on the next window().
+    """
+
+    def __init__(self, messages=()):
+        """Initialize the MessageHistory class"""
+        super().__init__(messages)
+        # model -> [0, tokens of message 0, tokens of messages 0-1, ...]
+        self._prefix_sums = {}
+        # The history_summary.RollingSummary of the evicted messages, if LLM_HISTORY_SUMMARY is on
+        self.summary = None
+
+    def _count(self, message, model) -> int:
+        # Counted the way chat_with_ai always has: one message at a time, reply priming included
+        return token_counter.count_message_tokens([message], model)
+
+    def _sums(self, model) -> list:
+        sums = self._prefix_sums.get(model)
+        if sums is None:
+            sums = [0]
+            for message in self:
+                sums.append(sums[-1] + self._count(message, model))
+            self._prefix_sums[model] = sums
+        return sums
+
+    def append(self, message):
+        super().append(message)
+        for model, sums in self._prefix_sums.items():
+            sums.append(sums[-1] + self._count(message, model))
+
+    def extend(self, messages):
+        for message in messages:
+            self.append(message)
+
+    def __iadd__(self, messages):
+        self.extend(messages)
+        return self
+
+    def _invalidate(self):
+        self._prefix_sums.clear()
+
+    def __setitem__(self, index, value):
+        super().__setitem__(index, value)
+        self._invalidate()
+
+    def __delitem__(self, index):
+        super().__delitem__(index)
+        self._invalidate()
+
+    def insert(self, index, message):
+        super().insert(index, message)
+        self._invalidate()
+
+    def pop(self, index=-1):
+        message = super().pop(index)
+        self._invalidate()
+        return message
+
+    def remove(self, message):
+        super().remove(message)
+        self._invalidate()
+
+    def clear(self):
+        super().clear()
+        self._invalidate()
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self._invalidate()
+
+    def reverse(self):
+        super().reverse()
+        self._invalidate()
+
+    def message_tokens(self, index: int, model: str) -> int:
+        """Return the token count of the message at index"""
+        sums = self._sums(model)
+        index = range(len(self))[index]
+        return sums[index + 1] - sums[index]
+
+    def tokens_since(self, start: int, model: str) -> int:
+        """Return the token count of the messages from start to the end"""
+        sums = self._sums(model)
+        return sums[-1] - sums[start]
+
+    def window_start(self, budget: int, model: str) -> int:
+        """
+        Find the longest run of most recent messages that fits a token budget.
+
+        Args:
+        budget (int): The number of tokens the messages may use.
+        model (str): The model the messages are counted for.
+
+        Returns:
+        int: The index of the oldest message of the run (len(self) if not even
+            the last message fits).
+        """
+        sums = self._sums(model)
+        return min(bisect.bisect_left(sums, sums[-1] - budget), len(self))
+
+    def window(self, budget: int, model: str):
+        """
+        Return the longest run of most recent messages that fits a token budget.
+
+        Args:
+        budget (int): The number of tokens the messages may use.
+        model (str): The model the messages are counted for.
+
+        Returns:
+        tuple: The messages, oldest first, and their token count.
+        """
+        start = self.window_start(budget, model)
+        return self[start:], self.tokens_since(start, model)
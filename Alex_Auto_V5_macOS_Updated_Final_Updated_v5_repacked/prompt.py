@@ -1,12 +1,12 @@
 from promptgenerator import PromptGenerator
 
 
-def get_prompt():
+def get_prompt_generator():
     """
-    This function generates a prompt string that includes various constraints, commands, resources, and performance evaluations.
+    This function builds a PromptGenerator populated with the constraints, commands, resources, and performance evaluations.
 
     Returns:
-        str: The generated prompt string.
+        PromptGenerator: The populated prompt generator.
     """
 
     # Initialize the PromptGenerator object
@@ -57,8 +57,19 @@ def get_prompt():
     prompt_generator.add_performance_evaluation("Reflect on past decisions and strategies to refine your approach.")
     prompt_generator.add_performance_evaluation("Every command has a cost, so be smart and efficient. Aim to complete tasks in the least number of steps.")
 
+    return prompt_generator
+
+
+def get_prompt():
+    """
+    This function generates a prompt string that includes various constraints, commands, resources, and performance evaluations.
+
+    Returns:
+        str: The generated prompt string.
+    """
+
     # Generate the prompt string
-    prompt_string = prompt_generator.generate_prompt_string()
+    prompt_string = get_prompt_generator().generate_prompt_string()
 
     return prompt_string
 
@@ -128,6 +128,48 @@ class PromptGenerator:
 
         return prompt_string
 
+    def generate_response_schema(self):
+        """
+        Generate a JSON schema for replies, built from the response format and the registered commands.
+
+        The command must name one of the registered commands and carry exactly its arguments.
+
+        Returns:
+            dict: The JSON schema.
+        """
+        thoughts = self.response_format["thoughts"]
+        command_schemas = [
+            {
+                "type": "object",
+                "properties": {
+                    "name": {"const": command["name"]},
+                    "args": {
+                        "type": "object",
+                        "properties": {arg: {"type": "string"} for arg in command["args"]},
+                        "required": list(command["args"]),
+                        "additionalProperties": False,
+                    },
+                },
+                "required": ["name", "args"],
+                "additionalProperties": False,
+            }
+            for command in self.commands
+        ]
+        return {
+            "type": "object",
+            "properties": {
+                "thoughts": {
+                    "type": "object",
+                    "properties": {key: {"type": "string"} for key in thoughts},
+                    "required": list(thoughts),
+                    "additionalProperties": False,
+                },
+                "command": {"anyOf": command_schemas},
+            },
+            "required": ["thoughts", "command"],
+            "additionalProperties": False,
+        }
+
 # Modified for enhanced functionality
 
 # Modified for enhanced functionality
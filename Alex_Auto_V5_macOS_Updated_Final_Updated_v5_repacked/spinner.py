@@ -22,11 +22,17 @@ class Spinner:
             time.sleep(self.delay)
             sys.stdout.write('\r' + ' ' * (len(self.message) + 2) + '\r')
 
+    def update_message(self, new_message):
+        """Replace the message shown next to the spinner"""
+        sys.stdout.write('\r' + ' ' * (len(self.message) + 2) + '\r')
+        self.message = new_message
+
     def __enter__(self):
         """Start the spinner"""
         self.running = True
         self.spinner_thread = threading.Thread(target=self.spin)
         self.spinner_thread.start()
+        return self
 
     def __exit__(self, exc_type, exc_value, exc_traceback):
         """Stop the spinner"""
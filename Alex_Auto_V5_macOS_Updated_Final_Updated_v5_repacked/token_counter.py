@@ -1,5 +1,7 @@
+import threading
 import tiktoken
 from typing import List, Dict
+from llm_metrics import metrics
 
 
 def count_message_tokens(messages : List[Dict[str, str]], model : str = "gpt-3.5-turbo-0301") -> int:
@@ -16,7 +18,7 @@ def count_message_tokens(messages : List[Dict[str, str]], model : str = "gpt-3.5
     try:
         encoding = tiktoken.encoding_for_model(model)
     except KeyError:
-        logger.warn("Warning: model not found. Using cl100k_base encoding.")
+        # Local models: estimate with cl100k_base, calibration corrects for the real tokenizer
         encoding = tiktoken.get_encoding("cl100k_base")
     if model == "gpt-3.5-turbo":
         # !Node: gpt-3.5-turbo may change over time. Returning num tokens assuming gpt-3.5-turbo-0301.")
@@ -31,7 +33,9 @@ def count_message_tokens(messages : List[Dict[str, str]], model : str = "gpt-3.5
         tokens_per_message = 3
         tokens_per_name = 1
     else:
-        raise NotImplementedError(f"""num_tokens_from_messages() is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens.""")
+        # Chat templates of local models differ; TokenCalibration learns the real overhead
+        tokens_per_message = 4
+        tokens_per_name = -1
     num_tokens = 0
     for message in messages:
         num_tokens += tokens_per_message
@@ -54,10 +58,96 @@ def count_string_tokens(string: str, model_name: str) -> int:
     Returns:
     int: The number of tokens in the text string.
     """
-    encoding = tiktoken.encoding_for_model(model_name)
+    try:
+        encoding = tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        encoding = tiktoken.get_encoding("cl100k_base")
     num_tokens = len(encoding.encode(string))
     return num_tokens
 
+
+class TokenCalibration:
+    """
+    Maps local token estimates onto the prompt token counts the server reports.
+
+    Local models tokenize differently from tiktoken and wrap messages in their
+    own chat templates, so for every model we fit actual = ratio * estimate +
+    overhead to recent (estimate, usage.prompt_tokens) pairs, weighting recent
+    pairs more. A margin of twice the typical fit error keeps budgets on the
+    safe side.
+    """
+
+    def __init__(self, decay=0.9, min_ratio=0.5, max_ratio=3.0):
+        """Initialize the TokenCalibration class"""
+        self.decay = decay
+        self.min_ratio = min_ratio
+        self.max_ratio = max_ratio
+        self._lock = threading.Lock()
+        self._fits = {}
+
+    def observe(self, model: str, estimated: int, actual: int) -> None:
+        """Record that a prompt estimated at estimated tokens was counted as actual tokens by the server"""
+        if not estimated or not actual:
+            return
+        with self._lock:
+            fit = self._fits.setdefault(model, {"n": 0.0, "x": 0.0, "y": 0.0, "xx": 0.0, "xy": 0.0, "error": None})
+            predicted = self._predict(fit, estimated)
+            for key, value in (("n", 1.0), ("x", estimated), ("y", actual),
+                               ("xx", estimated * estimated), ("xy", estimated * actual)):
+                fit[key] = fit[key] * self.decay + value
+            if predicted is not None:
+                error = abs(actual - predicted)
+                fit["error"] = error if fit["error"] is None else fit["error"] * self.decay + error * (1 - self.decay)
+            ratio, overhead = self._line(fit)
+        metrics.set_gauge(f"llm_token_ratio[{model}]", round(ratio, 4))
+        metrics.set_gauge(f"llm_token_overhead[{model}]", round(overhead, 1))
+
+    def correct(self, model: str, estimated: int) -> int:
+        """Return the number of tokens the server is expected to count for a prompt estimated at estimated"""
+        with self._lock:
+            fit = self._fits.get(model)
+            if fit is None:
+                return estimated
+            margin = 2 * (fit["error"] or 0)
+            return int(round(self._predict(fit, estimated) + margin))
+
+    def budget(self, model: str, limit: int) -> int:
+        """Return the largest estimate whose corrected token count fits in limit"""
+        with self._lock:
+            fit = self._fits.get(model)
+            if fit is None:
+                return limit
+            ratio, overhead = self._line(fit)
+            margin = 2 * (fit["error"] or 0)
+        return max(0, int((limit - overhead - margin) / ratio))
+
+    def stats(self) -> dict:
+        """Return the ratio, overhead and typical error of every calibrated model"""
+        with self._lock:
+            return {model: dict(zip(("ratio", "overhead"), self._line(fit)), error=fit["error"])
+                    for model, fit in self._fits.items()}
+
+    def _predict(self, fit: dict, estimated: int):
+        if not fit["n"]:
+            return None
+        ratio, overhead = self._line(fit)
+        return ratio * estimated + overhead
+
+    def _line(self, fit: dict):
+        n, x, y = fit["n"], fit["x"], fit["y"]
+        variance = n * fit["xx"] - x * x
+        ratio = None
+        if variance > 1e-6 * n * fit["xx"]:
+            # Least squares needs prompts of different lengths
+            ratio = (n * fit["xy"] - x * y) / variance
+        if ratio is None or not self.min_ratio <= ratio <= self.max_ratio:
+            return min(self.max_ratio, max(self.min_ratio, y / x)), 0.0
+        return ratio, (y - ratio * x) / n
+
+
+calibration = TokenCalibration()
+
+
 # Modified for enhanced functionality
 
 # Modified for enhanced functionality